@@ -28,6 +28,16 @@ import os
 import subprocess
 import sys
 
+import pyalpm
+
+# Use Cnchi's pacman modules (from this source tree or from the installed Cnchi)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.append("/usr/share/cnchi/src")
+
+from pacman.pacman_conf import PacmanConfig
+from pacman.sync_index import SyncIndex
+
+PACMAN_CONF = "/etc/pacman.conf"
 XML_URL = "https://raw.githubusercontent.com/Antergos/Cnchi/master/data/packages.xml"
 XML_FILE = "packages.xml"
 
@@ -59,17 +69,19 @@ def get_pkg_names():
 
     return sorted(list(set(names)))
 
+def get_sync_index(conf_path=PACMAN_CONF):
+    """ Opens an alpm handle with pacman.conf repositories """
+    conf = PacmanConfig(conf_path)
+    handle = pyalpm.Handle(conf.options["RootDir"], conf.options["DBPath"])
+    conf.apply(handle)
+    return SyncIndex(handle)
+
 def check_names(pkgs):
-    """ Checks if package exists calling pacman """
+    """ Checks if package exists (name, provides or group) using pyalpm """
+    sync_index = get_sync_index()
     not_found = []
     for pkg_name in pkgs:
-        cmd = ["pacman", "-Ss", pkg_name]
-        try:
-            output = subprocess.check_output(cmd).decode()
-        except subprocess.CalledProcessError:
-            output = ""
-
-        if pkg_name in output:
+        if sync_index.is_available(pkg_name):
             print("{}...OK!".format(pkg_name))
         else:
             not_found.append(pkg_name)
@@ -459,6 +459,10 @@ class CnchiInit():
         parser.add_argument(
             "-f", "--force", help=_("Runs cnchi even when another instance is running"),
             action="store_true")
+        parser.add_argument(
+            "-m", "--metalink",
+            help=_("Exports the download plan to a metalink file (for debugging purposes)"),
+            nargs='?')
         parser.add_argument(
             "-n", "--no-check", help=_("Makes checks optional in check screen"),
             action="store_true")
@@ -63,6 +63,8 @@ class Settings():
             'desktop_ask': True,
             'desktop_manager': 'lightdm',
             'desktops': [],
+            'downloads_max_per_host': 2,
+            'downloads_max_workers': 4,
             'enable_alongside': True,
             'encrypt_home': False,
             'f2fs': False,
@@ -96,10 +98,12 @@ class Settings():
             'luks_root_password': '',
             'luks_root_volume': '',
             'luks_root_device': '',
+            'metalink_file': '',
             'network_manager': 'NetworkManager',
             'pacman_config_file': '/etc/pacman.conf',
             'partition_mode': 'automatic',
             'proxies': None,
+            'rankmirrors_cache_ttl': 21600,
             'rankmirrors_done': False,
             'rankmirrors_pipe': None,
             'rankmirrors_result': '',
@@ -30,24 +30,32 @@
 
 import os
 import logging
+import hashlib
 
 import pyalpm
 
 try:
-    import pacman.pac as pac
+    import pacman.alpm_session as alpm_session
+    import pacman.pacman_conf as pacman_conf
     import download.metalink as ml
     import download.download_requests as download_requests
+    import download.download_plan as dplan
+    import download.download_hash as dhash
 except ModuleNotFoundError:
     import sys
     CNCHI_PATH = "/usr/share/cnchi"
     sys.path.append(CNCHI_PATH)
     sys.path.append(os.path.join(CNCHI_PATH, "src"))
-    import pacman.pac as pac
+    import pacman.alpm_session as alpm_session
+    import pacman.pacman_conf as pacman_conf
     import metalink as ml
     import download_requests
+    import download_plan as dplan
+    import download_hash as dhash
 
 from misc.events import Events
 import misc.extra as misc
+import mirrorlist
 
 # When testing, no _() is available
 try:
@@ -60,6 +68,9 @@ class DownloadPackages():
     """ Class to download packages. This class tries to previously download
         all necessary packages for  Antergos installation using requests. """
 
+    # Resolved download plan is stored here (inside settings['temp'])
+    PLAN_CACHE_FILENAME = 'download-plan.json'
+
     def __init__(self, package_names, pacman_conf, settings=None, callback_queue=None):
         """ Initialize DownloadPackages class. Gets default configuration """
 
@@ -83,9 +94,12 @@ class DownloadPackages():
         # (to prevent repeating events)
         self.last_event = {}
 
-        # List of packages' metalinks
+        # Download plan (dict of download_plan.DownloadItem objects)
         self.metalinks = None
 
+        # Position of each mirror host in the ranked mirrorlist
+        self.mirror_ranks = None
+
     def start_download(self, metalinks=None):
         """ Begin download """
         if metalinks:
@@ -100,48 +114,126 @@ class DownloadPackages():
             txt = _("Can't create download package list.")
             raise misc.InstallError(txt)
 
+        metalink_file = self.settings.get('metalink_file')
+        if metalink_file:
+            self.write_metalink(metalink_file)
+
         proxies = self.settings.get("proxies")
 
         download = download_requests.Download(
             self.pacman_cache_dir,
             self.xz_cache_dirs,
             self.events.queue,
-            proxies)
+            proxies,
+            max_workers=self.settings.get('downloads_max_workers'),
+            max_connections_per_host=self.settings.get('downloads_max_per_host'),
+            index_dir=self.settings.get('temp'))
 
         if not download.start(self.metalinks):
             # When we can't download (even one package), we stop right here
             txt = _("Can't download needed packages. Cnchi can't continue.")
             raise misc.InstallError(txt)
 
+    def get_mirror_ranks(self):
+        """ Compiles the mirrorlist we created earlier (rankmirrors) into a
+            dict that maps each mirror host to its position. Done only once.
+            If rankmirrors has not been run, urls keep their servers order
+            (the mirrorlist files order) """
+        if self.mirror_ranks is None:
+            self.mirror_ranks = {}
+            ranked = self.settings.get('rankmirrors_result') or []
+            for position, mirror_url in enumerate(ranked):
+                if mirror_url:
+                    host = mirrorlist.get_host(mirror_url)
+                    self.mirror_ranks.setdefault(host, position)
+        return self.mirror_ranks
+
     def url_sort_helper(self, url):
         """ helper method for sorting mirror urls """
         if not url:
             return 9999
-        # Use the mirrorlist we created earlier to determine a url's priority
-        ranked = self.settings.get('rankmirrors_result')
         # Use the first part of the URL to find its position in the ranked mirror list
-        partial = '/'.join(url.split('/')[:3])
-        position = [i for i, s in enumerate(ranked) if partial in s] or [9999]
-        return position[0]
-
-    def add_metalink_info(self, metalink):
-        """ Adds metalink info to metalinks list """
-        # Get metalink info
-        metalink_info = ml.get_info(metalink)
-
-        # Update downloads list with the new info from
-        # the processed metalink
-        for key in metalink_info:
+        return self.get_mirror_ranks().get(mirrorlist.get_host(url), 9999)
+
+    def add_download_plan(self, download_plan):
+        """ Adds download plan items to metalinks list """
+        for key, item in download_plan.items():
             if key not in self.metalinks:
-                self.metalinks[key] = metalink_info[key]
-                urls = metalink_info[key]['urls']
                 if self.settings:
                     # Sort urls based on the rankmirrors mirrorlist
-                    sorted_urls = sorted(urls, key=self.url_sort_helper)
-                    self.metalinks[key]['urls'] = sorted_urls
-                else:
-                    # When testing, settings is not available
-                    self.metalinks[key]['urls'] = urls
+                    item.urls = tuple(sorted(item.urls, key=self.url_sort_helper))
+                # When testing, settings is not available
+                self.metalinks[key] = item
+
+    def write_metalink(self, path):
+        """ Exports the download plan as a metalink xml file (only if
+            settings 'metalink_file' is set, Cnchi itself does not need it) """
+        if self.metalinks:
+            metalink = ml.plan_to_metalink(self.metalinks)
+            try:
+                with open(path, 'w') as metalink_file:
+                    metalink_file.write(str(metalink))
+                logging.debug("Download plan exported to %s", path)
+            except OSError as err:
+                logging.warning("Can't write metalink file %s: %s", path, err)
+
+    def get_plan_key(self):
+        """ Returns a hash of everything the download plan depends on:
+            package list, pacman.conf (and its repositories servers), sync
+            databases and the list of installed packages. Returns None if it can't be computed """
+        plan_hash = hashlib.sha256()
+        try:
+            for name in sorted(set(self.package_names)):
+                plan_hash.update(name.encode('utf-8') + b'\0')
+
+            with open(self.pacman_conf_file, 'rb') as conf_file:
+                plan_hash.update(conf_file.read())
+
+            conf = pacman_conf.PacmanConfig(conf=self.pacman_conf_file)
+            db_path = conf.options['DBPath']
+            for repo in conf.repos:
+                db_file = os.path.join(db_path, 'sync', repo + '.db')
+                plan_hash.update(repo.encode('utf-8') + b'\0')
+                # Servers come from Included mirrorlists, too
+                for server in conf.repos[repo]:
+                    plan_hash.update(server.encode('utf-8') + b'\0')
+                dhash.update_hash_from_file(plan_hash, db_file)
+
+            local_path = os.path.join(db_path, 'local')
+            if os.path.isdir(local_path):
+                for name in sorted(os.listdir(local_path)):
+                    plan_hash.update(name.encode('utf-8') + b'\0')
+        except (OSError, pacman_conf.InvalidSyntax) as err:
+            logging.debug("Can't compute download plan key: %s", err)
+            return None
+        return plan_hash.hexdigest()
+
+    def get_plan_cache_path(self):
+        """ Returns where the resolved download plan is stored """
+        if not self.settings or not self.settings.get('temp'):
+            return None
+        return os.path.join(
+            self.settings.get('temp'), DownloadPackages.PLAN_CACHE_FILENAME)
+
+    def load_cached_plan(self, plan_key):
+        """ Loads the download plan stored by a previous run with the
+            same inputs (if any) """
+        path = self.get_plan_cache_path()
+        if path and plan_key:
+            download_plan = dplan.load_plan(path, plan_key)
+            if download_plan:
+                logging.debug(
+                    "Using stored download plan (%d files) from %s",
+                    len(download_plan), path)
+                return download_plan
+        return None
+
+    def save_cached_plan(self, plan_key, download_plan):
+        """ Stores the download plan, so it is not resolved again if
+            Cnchi is restarted """
+        path = self.get_plan_cache_path()
+        if path and plan_key:
+            dplan.save_plan(download_plan, path, plan_key)
 
     @misc.raise_privileges
     def create_metalinks_list(self):
@@ -150,17 +242,21 @@ class DownloadPackages():
         self.events.add('percent', 0)
         self.events.add(
             'info', _('Creating the list of packages to download...'))
-        processed_packages = 0
-        total_packages = len(self.package_names)
 
         self.metalinks = {}
 
+        plan_key = self.get_plan_key()
+        download_plan = self.load_cached_plan(plan_key)
+        if download_plan:
+            self.add_download_plan(download_plan)
+            self.events.add('percent', 1)
+            self.events.add('info', "")
+            return True
+
         try:
-            pacman = pac.Pac(
-                conf_path=self.pacman_conf_file,
-                callback_queue=self.events.queue)
-            if pacman is None:
-                return False
+            # Use the same alpm handle SelectPackages has used (if any)
+            pacman = alpm_session.get_session(
+                self.pacman_conf_file, self.events.queue).pacman
         except pyalpm.error as ex:
             self.metalinks = None
             template = "Can't initialize pyalpm. " \
@@ -170,25 +266,19 @@ class DownloadPackages():
             return False
 
         try:
-            for package_name in self.package_names:
-                metalink = ml.create(pacman, package_name,
-                                     self.pacman_conf_file)
-                if metalink is None:
-                    txt = "Error creating metalink for package %s. Installation will stop"
-                    logging.error(txt, package_name)
-                    txt = _("Error creating metalink for package {}. "
-                            "Installation will stop").format(package_name)
-                    raise misc.InstallError(txt)
-
-                self.add_metalink_info(metalink)
-
-                # Show progress to the user
-                processed_packages += 1
-                percent = round(float(processed_packages / total_packages), 2)
-                self.events.add('percent', percent)
-
-            pacman.release()
-            del pacman
+            # Resolve all packages (and their dependencies) in one pass
+            download_plan = ml.create(pacman, self.package_names,
+                                      self.pacman_conf_file)
+            if download_plan is None:
+                txt = "Error creating metalink for packages %s. Installation will stop"
+                logging.error(txt, ' '.join(self.package_names))
+                txt = _("Error creating metalink for packages. "
+                        "Installation will stop")
+                raise misc.InstallError(txt)
+
+            self.save_cached_plan(plan_key, download_plan)
+            self.add_download_plan(download_plan)
+            self.events.add('percent', 1)
         except (KeyError, pyalpm.error) as ex:
             template = "Can't create download set. " \
                 "An exception of type {0} occured. Arguments:\n{1!r}"
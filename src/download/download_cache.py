@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# download_cache.py
+#
+# Copyright © 2013-2018 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Index of verified packages stored in a xz cache directory """
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+try:
+    import download.download_hash as dhash
+except ModuleNotFoundError:
+    import download_hash as dhash
+
+
+class CacheIndex():
+    """ Maps each file in a cache directory to its size, mtime and sha256,
+        so a package is only hashed again when it changes """
+
+    INDEX_FILENAME = '.cnchi-cache-index.json'
+    INDEX_VERSION = 1
+
+    def __init__(self, cache_dir, index_dir=None):
+        """ The index is stored inside cache_dir. If cache_dir is not
+            writable (the ISO cache, for instance) it is stored in index_dir """
+        self.cache_dir = cache_dir
+        if os.access(cache_dir, os.W_OK) or not index_dir:
+            self.index_path = os.path.join(cache_dir, CacheIndex.INDEX_FILENAME)
+        else:
+            name = hashlib.sha1(os.path.abspath(cache_dir).encode()).hexdigest()
+            self.index_path = os.path.join(
+                index_dir, 'cache-index-{}.json'.format(name))
+
+        # filename: (size, mtime) of all files in cache_dir
+        self.entries = {}
+        # filename: [size, mtime, sha256] of already hashed files
+        self.verified = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Loads stored index (if any) and scans the cache directory """
+        try:
+            with open(self.index_path, 'r') as index_file:
+                data = json.load(index_file)
+            if data.get('version') == CacheIndex.INDEX_VERSION:
+                self.verified = data.get('files', {})
+        except (OSError, ValueError, AttributeError) as err:
+            if not isinstance(err, FileNotFoundError):
+                logging.debug("Can't read %s: %s", self.index_path, err)
+            self.verified = {}
+        self.scan()
+
+    def scan(self):
+        """ Reads size and mtime of all files with one os.scandir pass.
+            Index entries of changed or deleted files are dropped """
+        self.entries = {}
+        try:
+            with os.scandir(self.cache_dir) as dir_entries:
+                for entry in dir_entries:
+                    if entry.name.startswith('.') or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    self.entries[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        except OSError as err:
+            logging.debug("Can't scan %s: %s", self.cache_dir, err)
+
+        for filename in list(self.verified.keys()):
+            record = self.verified[filename]
+            if tuple(record[:2]) != self.entries.get(filename):
+                del self.verified[filename]
+                self.changed = True
+
+        logging.debug(
+            "%s: %d files, %d already verified",
+            self.cache_dir, len(self.entries), len(self.verified))
+
+    def lookup(self, element):
+        """ Returns element's file path if it is in this cache directory
+            and its hash is correct. Returns None otherwise """
+        filename = element.filename
+        stat = self.entries.get(filename)
+        if stat is None:
+            return None
+
+        path = os.path.join(self.cache_dir, filename)
+
+        sha256 = dhash.get_element_hash(element, 'sha256')
+        if not sha256:
+            # Can't use the index, check whatever hash we have
+            try:
+                return path if dhash.check_hash(path, element) else None
+            except OSError as err:
+                logging.debug("Can't check cached file %s: %s", path, err)
+                return None
+
+        with self.lock:
+            record = self.verified.get(filename)
+
+        if record is None:
+            try:
+                file_hash = dhash.get_file_hash(path, 'sha256')
+            except OSError as err:
+                logging.debug("Can't check cached file %s: %s", path, err)
+                file_hash = None
+            if file_hash is None:
+                # Removed or unreadable since the directory was scanned,
+                # the package will be downloaded
+                return None
+            with self.lock:
+                self.verified[filename] = [stat[0], stat[1], file_hash]
+                self.changed = True
+        else:
+            file_hash = record[2]
+
+        if file_hash != sha256:
+            logging.warning("SHA256 hash of file %s does not match!", filename)
+            return None
+
+        return path
+
+    def save(self):
+        """ Stores the index (only if it has changed) """
+        if not self.changed:
+            return
+        tmp_path = self.index_path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.index_path), mode=0o755, exist_ok=True)
+            with self.lock:
+                data = {
+                    'version': CacheIndex.INDEX_VERSION,
+                    'files': self.verified}
+                with open(tmp_path, 'w') as index_file:
+                    json.dump(data, index_file)
+                os.rename(tmp_path, self.index_path)
+                self.changed = False
+        except OSError as err:
+            logging.debug("Can't write %s: %s", self.index_path, err)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# download_copy.py
+#
+# Copyright © 2013-2018 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Copies package files without moving their data through Python when possible """
+
+import fcntl
+import os
+import shutil
+
+# ioctl number of FICLONE (reflink a whole file, btrfs and xfs)
+FICLONE = 0x40049409
+
+# Maximum number of bytes sent with each copy_file_range/sendfile call
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def link_file(src, dst):
+    """ Hardlink (only works if src and dst are in the same filesystem) """
+    os.link(src, dst)
+
+
+def reflink_file(src, dst):
+    """ Reflink, both files share their data blocks until one is modified """
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def copy_range_file(src, dst):
+    """ In-kernel copy using copy_file_range (or sendfile if not available) """
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        size = os.fstat(src_file.fileno()).st_size
+        copy_func = getattr(os, 'copy_file_range', None)
+        offset = 0
+        while offset < size:
+            count = min(CHUNK_SIZE, size - offset)
+            if copy_func:
+                sent = copy_func(src_file.fileno(), dst_file.fileno(), count)
+            else:
+                sent = os.sendfile(dst_file.fileno(), src_file.fileno(), offset, count)
+            if sent == 0:
+                break
+            offset += sent
+        if offset != size:
+            raise OSError("Short copy of {} ({}/{} bytes)".format(src, offset, size))
+
+
+COPY_METHODS = (
+    ('hardlink', link_file),
+    ('reflink', reflink_file),
+    ('copy_file_range', copy_range_file),
+    ('buffered', shutil.copyfile))
+
+
+def copy_file(src, dst):
+    """ Copies src to dst trying a hardlink first, then a reflink, then an
+        in-kernel copy and, if everything else fails, a buffered copy.
+        The file is copied to a hidden temporary name and then renamed, so
+        dst never holds a partial file. Returns the method used. """
+    tmp_dst = os.path.join(
+        os.path.dirname(dst), '.{}.tmp'.format(os.path.basename(dst)))
+
+    last_error = None
+    for method_name, method in COPY_METHODS:
+        try:
+            if os.path.lexists(tmp_dst):
+                os.remove(tmp_dst)
+            method(src, tmp_dst)
+            os.rename(tmp_dst, dst)
+            return method_name
+        except OSError as err:
+            # Not supported here (cross-device link, no reflinks...), try next one
+            last_error = err
+
+    try:
+        os.remove(tmp_dst)
+    except OSError:
+        pass
+    raise OSError("Can't copy {0} to {1}: {2}".format(src, dst, last_error))
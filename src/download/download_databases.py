@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# download_databases.py
+#
+# Copyright © 2013-2018 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Refreshes pacman sync databases (all repositories at the same time) """
+
+import concurrent.futures
+import email.utils
+import logging
+import os
+import shutil
+
+import requests
+
+try:
+    from download.download_session import SessionPool
+except ModuleNotFoundError:
+    from download_session import SessionPool
+
+
+class DatabaseRefresh():
+    """ Downloads the sync databases of a pacman configuration using
+        conditional requests (If-Modified-Since and If-None-Match).
+        Databases already present in seed_db_path (the live system) are
+        copied first, so usually only the ones that have changed are
+        downloaded """
+
+    # Sync databases of the live system
+    LIVE_DB_PATH = '/var/lib/pacman'
+    CHUNK_SIZE = 64 * 1024
+    TIMEOUT = 30
+
+    def __init__(self, conf, proxies=None, seed_db_path=LIVE_DB_PATH):
+        """ conf is a pacman.pacman_conf.PacmanConfig object """
+        self.conf = conf
+        self.sync_dir = os.path.join(conf.options['DBPath'], 'sync')
+        self.seed_db_path = seed_db_path
+        self.sessions = SessionPool(proxies)
+
+    def get_servers(self, repo):
+        """ Returns repo's database urls """
+        arch = self.conf.options['Architecture']
+        servers = []
+        for server in self.conf.repos[repo]:
+            url = server.replace('$repo', repo).replace('$arch', arch)
+            servers.append('{0}/{1}.db'.format(url.rstrip('/'), repo))
+        return servers
+
+    def seed_database(self, repo, db_file):
+        """ Copies repo's database from the live system (keeping its mtime,
+            which is sent as If-Modified-Since later) """
+        if not self.seed_db_path or os.path.exists(db_file):
+            return
+        seed_sync_dir = os.path.join(self.seed_db_path, 'sync')
+        if os.path.realpath(seed_sync_dir) == os.path.realpath(self.sync_dir):
+            return
+        for filename in (repo + '.db', repo + '.db.sig'):
+            src = os.path.join(seed_sync_dir, filename)
+            if os.path.exists(src):
+                try:
+                    shutil.copy2(src, os.path.join(self.sync_dir, filename))
+                except OSError as err:
+                    logging.debug("Can't copy %s: %s", src, err)
+                    return
+        if os.path.exists(db_file):
+            logging.debug("%s database copied from %s", repo, seed_sync_dir)
+
+    @staticmethod
+    def get_etag_path(db_file):
+        """ ETag of each database is stored next to it """
+        return os.path.join(
+            os.path.dirname(db_file), '.{}.etag'.format(os.path.basename(db_file)))
+
+    def get_headers(self, db_file):
+        """ Conditional request headers for db_file (if it exists) """
+        headers = {}
+        try:
+            mtime = os.stat(db_file).st_mtime
+            headers['If-Modified-Since'] = email.utils.formatdate(mtime, usegmt=True)
+            with open(self.get_etag_path(db_file), 'r') as etag_file:
+                headers['If-None-Match'] = etag_file.read().strip()
+        except OSError:
+            pass
+        return headers
+
+    def download_file(self, url, path, headers=None):
+        """ Downloads url into path. Returns the response status code
+            (304 if it has not changed) """
+        with self.sessions.get(url, headers=headers, stream=True,
+                               timeout=DatabaseRefresh.TIMEOUT) as req:
+            if req.status_code != 200:
+                return req.status_code
+
+            tmp_path = path + '.part'
+            with open(tmp_path, 'wb') as tmp_file:
+                for data in req.iter_content(DatabaseRefresh.CHUNK_SIZE):
+                    tmp_file.write(data)
+
+            # Use server's time, so If-Modified-Since works next time
+            last_modified = req.headers.get('Last-Modified')
+            if last_modified:
+                try:
+                    mtime = email.utils.parsedate_to_datetime(last_modified).timestamp()
+                    os.utime(tmp_path, (mtime, mtime))
+                except (TypeError, ValueError, OverflowError):
+                    pass
+            os.rename(tmp_path, path)
+
+            etag = req.headers.get('ETag')
+            etag_path = self.get_etag_path(path)
+            if etag:
+                with open(etag_path, 'w') as etag_file:
+                    etag_file.write(etag)
+            elif os.path.exists(etag_path):
+                os.remove(etag_path)
+            return 200
+
+    def refresh_database(self, repo):
+        """ Updates repo's database trying all its servers. Returns True if
+            it is up to date (or has been downloaded) """
+        db_file = os.path.join(self.sync_dir, repo + '.db')
+        self.seed_database(repo, db_file)
+        for url in self.get_servers(repo):
+            try:
+                status = self.download_file(url, db_file, self.get_headers(db_file))
+                if status == 304:
+                    logging.debug("%s database is up to date", repo)
+                    return True
+                if status == 200:
+                    # Signature must match the new database (if there is one)
+                    sig_file = db_file + '.sig'
+                    if self.download_file(url + '.sig', sig_file) != 200:
+                        if os.path.exists(sig_file):
+                            os.remove(sig_file)
+                    logging.debug("%s database downloaded from %s", repo, url)
+                    return True
+                logging.debug("Can't download %s: HTTP error %d", url, status)
+            except (OSError, requests.RequestException) as err:
+                logging.debug("Can't download %s: %s", url, err)
+        logging.warning("Can't refresh %s database", repo)
+        return False
+
+    def refresh(self):
+        """ Refreshes all databases at the same time """
+        repos = list(self.conf.repos.keys())
+        if not repos:
+            return True
+        os.makedirs(self.sync_dir, mode=0o755, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(repos)) as executor:
+            results = list(executor.map(self.refresh_database, repos))
+        self.sessions.log_stats()
+        self.sessions.close()
+        return all(results)
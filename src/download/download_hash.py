@@ -29,16 +29,24 @@
 
 """ Module to check downloaded packages hash """
 
+import concurrent.futures
 import hashlib
 import logging
 import os
 
+# Files are read in big chunks, so hashlib (which releases the GIL
+# for big buffers) spends most of the time outside the interpreter
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Number of files checked at the same time by check_hashes
+HASH_WORKERS = 4
+
 def check_hash(path, element, queue_event=None):
     """ Checks file hash (sha256 or md5) """
     # Note: path must exist!
 
-    identity = element['identity']
-    filename = element['filename']
+    identity = element.identity
+    filename = element.filename
 
     sha256 = get_element_hash(element, 'sha256')
     md5 = get_element_hash(element, 'md5')
@@ -52,7 +60,7 @@ def check_hash(path, element, queue_event=None):
         return True
 
     logging.warning(
-        "Element %s (%s) has no SHA256 hash info in its metalink", identity, filename)
+        "Element %s (%s) has no SHA256 hash info in its download plan", identity, filename)
 
     # sha256 not available let's check md5
     if md5:
@@ -63,7 +71,7 @@ def check_hash(path, element, queue_event=None):
         return True
 
     logging.warning(
-        "Element %s (%s) has no MD5 hash info in its metalink", identity, filename)
+        "Element %s (%s) has no MD5 hash info in its download plan", identity, filename)
 
     logging.debug(
         'Checksum unavailable for package: %s (%s)', identity, filename)
@@ -71,6 +79,25 @@ def check_hash(path, element, queue_event=None):
         queue_event('cache_pkgs_md5_check_failed', identity)
     return True
 
+def check_hashes(paths_and_elements, max_workers=HASH_WORKERS):
+    """ Checks the hash of several files at the same time.
+        paths_and_elements is a list of (path, element) tuples.
+        Returns a list of booleans (in the same order) """
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(check_hash, path, element)
+                   for path, element in paths_and_elements]
+        return [future.result() for future in futures]
+
+def update_hash_from_file(myhash, path):
+    """ Adds path contents to myhash, reading HASH_BUFFER_SIZE bytes each time """
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as myfile:
+        size = myfile.readinto(buf)
+        while size:
+            myhash.update(view[:size])
+            size = myfile.readinto(buf)
+
 def get_file_hash(path, hash_type):
     """ Gets md5 or sha256 hash from a file """
 
@@ -82,16 +109,127 @@ def get_file_hash(path, hash_type):
     else:
         myhash = hashlib.sha256()
 
-    with open(path, 'rb') as myfile:
-        for line in myfile:
-            myhash.update(line)
+    update_hash_from_file(myhash, path)
 
     return myhash.hexdigest()
 
+class StreamHash():
+    """ Computes a package hash while it is being downloaded, so the
+        file does not have to be read again to check it """
+
+    def __init__(self, element):
+        self.element = element
+        self.hash_type = None
+        self.expected = None
+        for hash_type in ('sha256', 'md5'):
+            self.expected = get_element_hash(element, hash_type)
+            if self.expected:
+                self.hash_type = hash_type
+                break
+        if self.hash_type == 'md5':
+            self.hash = hashlib.md5()
+        else:
+            self.hash = hashlib.sha256()
+
+    def update(self, data):
+        """ Adds downloaded data to the hash """
+        self.hash.update(data)
+
+    def update_from_file(self, path):
+        """ Adds the data already stored in path (a resumed download) """
+        update_hash_from_file(self.hash, path)
+
+    def check(self):
+        """ Checks computed hash against the element one """
+        filename = self.element.filename
+        if not self.expected:
+            logging.warning(
+                "Element %s (%s) has no hash info in its download plan",
+                self.element.identity, filename)
+            return True
+        if self.expected != self.hash.hexdigest():
+            logging.warning(
+                "%s hash of file %s does not match!", self.hash_type.upper(), filename)
+            return False
+        logging.debug("%s hash of %s is OK.", self.hash_type.upper(), filename)
+        return True
+
 def get_element_hash(element, hash_type):
-    """ Get hash from one metalink element """
-    hash_value = None
-    hashes = element.get('hash', None)
-    if hashes:
-        hash_value = hashes.get(hash_type, None)
-    return hash_value
+    """ Get hash ('sha256' or 'md5') from one download plan item """
+    return getattr(element, hash_type, None)
+
+
+def test_module():
+    """ Compares hashing throughput of the old and the new code """
+    import tempfile
+    import time
+
+    try:
+        from download.download_plan import DownloadItem
+    except ModuleNotFoundError:
+        from download_plan import DownloadItem
+
+    def old_get_file_hash(path):
+        """ Old download_hash.get_file_hash (reads lines) """
+        myhash = hashlib.sha256()
+        with open(path, 'rb') as myfile:
+            for line in myfile:
+                myhash.update(line)
+        return myhash.hexdigest()
+
+    def old_get_checksum(path):
+        """ Old metalink.get_checksum (reads block_size bytes) """
+        new_hash = hashlib.new('sha256')
+        block_size = new_hash.block_size
+        with open(path, 'rb') as myfile:
+            buf = myfile.read(block_size)
+            while buf:
+                new_hash.update(buf)
+                buf = myfile.read(block_size)
+        return new_hash.hexdigest()
+
+    num_files = 8
+    file_size = 32 * 1024 * 1024
+    total_mib = num_files * file_size / (1024 * 1024)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for index in range(num_files):
+            path = os.path.join(tmp_dir, 'test{}.pkg.tar.xz'.format(index))
+            with open(path, 'wb') as test_file:
+                test_file.write(os.urandom(file_size))
+            paths.append(path)
+
+        def run_test(name, func):
+            """ Hashes all test files with func and prints throughput """
+            time0 = time.perf_counter()
+            result = func()
+            dtime = time.perf_counter() - time0
+            print("{0:<32} {1:8.1f} MiB/s".format(name, total_mib / dtime))
+            return result
+
+        expected = run_test(
+            "old get_file_hash (lines)",
+            lambda: [old_get_file_hash(path) for path in paths])
+        run_test(
+            "old get_checksum (block_size)",
+            lambda: [old_get_checksum(path) for path in paths])
+        result = run_test(
+            "get_file_hash (one thread)",
+            lambda: [get_file_hash(path, 'sha256') for path in paths])
+        assert result == expected
+
+        elements = [
+            DownloadItem(
+                identity=os.path.basename(path),
+                filename=os.path.basename(path),
+                sha256=digest)
+            for path, digest in zip(paths, expected)]
+        result = run_test(
+            "check_hashes ({} threads)".format(HASH_WORKERS),
+            lambda: check_hashes(list(zip(paths, elements))))
+        assert all(result)
+
+
+if __name__ == '__main__':
+    test_module()
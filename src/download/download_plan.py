@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# download_plan.py
+#
+# Copyright © 2013-2018 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Download plan: the files Cnchi has to download (in memory) """
+
+import json
+import logging
+import os
+
+PLAN_VERSION = 1
+
+
+class DownloadItem():
+    """ One file of a download plan (a package, a signature or a db).
+        A download plan is a dict that maps identities to DownloadItems """
+
+    __slots__ = (
+        'identity', 'filename', 'version', 'size', 'description',
+        'sha256', 'md5', 'urls')
+
+    def __init__(self, identity, filename, version=None, size=0,
+                 description=None, sha256=None, md5=None, urls=()):
+        self.identity = identity
+        self.filename = filename
+        self.version = version
+        self.size = size
+        self.description = description
+        self.sha256 = sha256
+        self.md5 = md5
+        self.urls = tuple(urls)
+
+    @classmethod
+    def from_pkg(cls, pkg, urls):
+        """ Creates a DownloadItem from a pyalpm package """
+        return cls(
+            identity=pkg.name,
+            filename=pkg.filename,
+            version=pkg.version,
+            size=pkg.size,
+            description=pkg.desc,
+            sha256=pkg.sha256sum or None,
+            md5=pkg.md5sum or None,
+            urls=urls)
+
+    def __repr__(self):
+        return 'DownloadItem({0}, {1}, {2} urls)'.format(
+            self.identity, self.version, len(self.urls))
+
+    def to_dict(self):
+        """ Returns item as a dict (to store it as json) """
+        return {slot: getattr(self, slot) for slot in DownloadItem.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Creates a DownloadItem from a dict made by to_dict """
+        return cls(**data)
+
+
+def save_plan(download_plan, path, key):
+    """ Stores download plan as json. key identifies the inputs used to
+        create the plan (see load_plan) """
+    data = {
+        'version': PLAN_VERSION,
+        'key': key,
+        'items': [item.to_dict() for item in download_plan.values()]}
+    tmp_path = path + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        with open(tmp_path, 'w') as plan_file:
+            json.dump(data, plan_file)
+        os.rename(tmp_path, path)
+    except OSError as err:
+        logging.debug("Can't store download plan in %s: %s", path, err)
+
+
+def load_plan(path, key):
+    """ Loads a download plan stored by save_plan. Returns None if there is
+        none or if it was created from different inputs (key) """
+    try:
+        with open(path, 'r') as plan_file:
+            data = json.load(plan_file)
+        if data.get('version') != PLAN_VERSION or data.get('key') != key:
+            return None
+        download_plan = {}
+        for item_data in data['items']:
+            item = DownloadItem.from_dict(item_data)
+            download_plan[item.identity] = item
+        return download_plan
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as err:
+        logging.debug("Can't load download plan from %s: %s", path, err)
+        return None
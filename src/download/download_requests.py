@@ -31,11 +31,13 @@
 
 import os
 import logging
-import shutil
+import collections
 import time
 import socket
 import io
 import threading
+import urllib.parse
+import concurrent.futures
 
 import requests
 
@@ -43,8 +45,16 @@ from misc.events import Events
 
 try:
     import download.download_hash as dhash
+    import download.download_copy as dcopy
+    from download.download_session import SessionPool
+    from download.download_cache import CacheIndex
+    from download.download_scoreboard import MirrorScoreboard
 except ModuleNotFoundError:
     import download_hash as dhash
+    import download_copy as dcopy
+    from download_session import SessionPool
+    from download_cache import CacheIndex
+    from download_scoreboard import MirrorScoreboard
 
 # When testing, no _() is available
 try:
@@ -53,28 +63,51 @@ except NameError as err:
     def _(message):
         return message
 
-class CopyToCache(threading.Thread):
-    ''' Class thread to copy a xz file to the user's
-        provided cache directory '''
+class CopyToCache():
+    ''' Copies xz files to the user's provided cache directories
+        using a small pool of threads '''
 
     PACMAN_ISO_CACHE = "/var/cache/pacman/pkg"
+    MAX_WORKERS = 2
 
-    def __init__(self, origin, xz_cache_dirs):
-        threading.Thread.__init__(self)
-        self.origin = origin
-        self.xz_cache_dirs = xz_cache_dirs
-
-    def run(self):
-        basename = os.path.basename(self.origin)
-        for xz_cache_dir in self.xz_cache_dirs:
+    def __init__(self, xz_cache_dirs):
+        self.xz_cache_dirs = [
+            xz_cache_dir for xz_cache_dir in xz_cache_dirs
             # Avoid using the ISO itself
-            if xz_cache_dir != CopyToCache.PACMAN_ISO_CACHE:
-                dst = os.path.join(xz_cache_dir, basename)
-                # Try to copy the file, do not worry if it's not possible
-                try:
-                    shutil.copy(self.origin, dst)
-                except (FileNotFoundError, FileExistsError, OSError):
-                    pass
+            if xz_cache_dir != CopyToCache.PACMAN_ISO_CACHE]
+        self.executor = None
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def add(self, origin):
+        ''' Queues origin to be copied to all cache directories '''
+        if not self.xz_cache_dirs:
+            return
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    CopyToCache.MAX_WORKERS)
+            self.futures.append(self.executor.submit(self.copy, origin))
+
+    def copy(self, origin):
+        ''' Copies origin to all cache directories '''
+        basename = os.path.basename(origin)
+        for xz_cache_dir in self.xz_cache_dirs:
+            dst = os.path.join(xz_cache_dir, basename)
+            # Try to copy the file, do not worry if it's not possible
+            try:
+                dcopy.copy_file(origin, dst)
+            except OSError as os_error:
+                logging.debug(os_error)
+
+    def wait(self):
+        ''' Waits until all files have been copied '''
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+            self.futures = []
+        if executor is not None:
+            executor.shutdown(wait=True)
 
 
 class Download():
@@ -82,11 +115,41 @@ class Download():
         This class tries to previously download all necessary packages for
         Antergos installation using requests """
 
-    def __init__(self, pacman_cache_dir, xz_cache_dirs, callback_queue, proxies=None):
-        """ Initialize Download class. Gets default configuration """
+    # Number of packages that are fetched at the same time
+    MAX_WORKERS = 4
+    # Number of simultaneous connections allowed to the same mirror
+    MAX_CONNECTIONS_PER_HOST = 2
+    # Packages bigger than this are fetched in byte ranges from several mirrors
+    SEGMENTED_MIN_SIZE = 32 * 1024 * 1024
+    # Size of each byte range (fast mirrors will end up fetching more of them)
+    SEGMENT_SIZE = 4 * 1024 * 1024
+    # Maximum number of mirrors used at the same time for one package
+    MAX_SEGMENT_MIRRORS = 4
+    # Suffix of files that are still being downloaded
+    PART_SUFFIX = '.part'
+    # Suffix of files that are being downloaded in segments
+    SEGMENTS_SUFFIX = '.segments'
+
+    def __init__(self, pacman_cache_dir, xz_cache_dirs, callback_queue, proxies=None,
+                 max_workers=None, max_connections_per_host=None, index_dir=None,
+                 copy_cached=False):
+        """ Initialize Download class. Gets default configuration
+            index_dir is used to store the index of read only cache dirs.
+            Packages found in xz_cache_dirs are only copied to
+            pacman_cache_dir if copy_cached is True (otherwise, xz cache
+            dirs must be pacman CacheDirs too) """
         self.pacman_cache_dir = pacman_cache_dir
         self.xz_cache_dirs = xz_cache_dirs
         self.proxies = proxies
+        self.copy_cached = copy_cached
+
+        # Verified packages index of each xz cache directory
+        self.cache_indexes = [
+            CacheIndex(xz_cache_dir, index_dir) for xz_cache_dir in self.xz_cache_dirs]
+
+        self.max_workers = max_workers or Download.MAX_WORKERS
+        self.max_connections_per_host = (
+            max_connections_per_host or Download.MAX_CONNECTIONS_PER_HOST)
 
         self.events = Events(callback_queue)
 
@@ -99,104 +162,218 @@ class Download():
         # Stores last issued event (to prevent repeating events)
         self.last_event = {}
 
-        self.copy_to_cache_threads = []
+        self.copy_to_cache = CopyToCache(self.xz_cache_dirs)
+
+        # Workers share events, counters and host slots, so all
+        # of them are protected by this lock
+        self.lock = threading.Lock()
+        # One semaphore per mirror host (limits connections per host)
+        self.host_slots = {}
+        # Set when a package can't be downloaded (tells workers to stop)
+        self.stop_event = threading.Event()
+
+        # Keep-alive sessions, one for each mirror host
+        self.sessions = SessionPool(self.proxies, self.max_connections_per_host)
+
+        # Health of each mirror (shared by all workers)
+        self.scoreboard = MirrorScoreboard()
+
+        # Download progress (in bytes) of the whole package set
+        self.total_size = 0
+        self.completed_size = 0
+        self.transferred = 0
+        self.start_time = 0
+        self.started = 0
+        self.total_downloads = 0
+
+    def add_event(self, event_type, event_text=""):
+        """ Thread safe wrapper around Events.add """
+        with self.lock:
+            self.events.add(event_type, event_text)
 
+    @staticmethod
+    def get_element_size(element):
+        """ Returns package size stored in its download plan (0 if unknown) """
+        try:
+            return int(element.size)
+        except (KeyError, TypeError, ValueError):
+            return 0
+
+    def get_host_slot(self, url):
+        """ Returns the semaphore that limits connections to url's host """
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            slot = self.host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.max_connections_per_host)
+                self.host_slots[host] = slot
+        return slot
+
+    def update_progress(self, size, transferred=0):
+        """ Adds size bytes to the completed size of the package set and
+            shows global progress to the user """
+        with self.lock:
+            self.completed_size += size
+            self.transferred += transferred
+            percent = 0
+            if self.total_size > 0:
+                percent = round(float(self.completed_size / self.total_size), 2)
+                percent = min(max(percent, 0), 1)
+                self.events.add('percent', percent)
+            if transferred:
+                elapsed = time.perf_counter() - self.start_time
+                if elapsed > 0:
+                    bps = self.transferred // elapsed
+                    msg = self.format_progress_message(percent, bps)
+                    self.events.add('progress_bar_show_text', msg)
 
     def start(self, downloads):
         """ Downloads using requests """
         downloaded = 0
-        total_downloads = len(downloads)
+        elements = []
+        while downloads:
+            # Get packages to download from downloads list
+            _identity, element = downloads.popitem()
+            elements.append(element)
+
+        self.total_downloads = len(elements)
+        self.total_size = sum(self.get_element_size(element) for element in elements)
+        self.completed_size = 0
+        self.transferred = 0
+        self.started = 0
+        self.start_time = time.perf_counter()
+        self.stop_event.clear()
 
         self.events.add('downloads_progress_bar', 'show')
         self.events.add('downloads_percent', '0')
+        self.events.add('percent', 0)
 
-        self.copy_to_cache_threads = []
+        for cache_index in self.cache_indexes:
+            cache_index.load()
 
         logging.debug(
-            "Downloading packages to pacman cache dir '%s'",
-            self.pacman_cache_dir)
+            "Downloading packages to pacman cache dir '%s' (%d workers, "
+            "%d connections per host)",
+            self.pacman_cache_dir,
+            self.max_workers,
+            self.max_connections_per_host)
+
+        result = True
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            futures = [executor.submit(self.fetch_element, element)
+                       for element in elements]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    if not future.result():
+                        # None of the mirror urls works.
+                        # Stop right here, so the user does not have to wait
+                        # to download the other packages.
+                        result = False
+                        break
+
+                    downloaded += 1
+
+                    downloads_percent = round(
+                        float(downloaded / self.total_downloads), 2)
+                    self.add_event('downloads_percent', str(downloads_percent))
+            finally:
+                if downloaded < self.total_downloads:
+                    self.stop_event.set()
+                    for future in futures:
+                        future.cancel()
+
+        self.sessions.log_stats()
+        self.sessions.close()
+        self.scoreboard.log_stats()
+
+        for cache_index in self.cache_indexes:
+            cache_index.save()
+
+        if not result:
+            return False
 
-        while downloads:
-            needs_to_download = True
+        self.add_event('progress_bar_show_text', '')
 
-            # Get package to download from downloads list
-            _identity, element = downloads.popitem()
+        # Wait until all xz packages are also copied to provided cache (if any)
+        self.copy_to_cache.wait()
+
+        self.events.add('downloads_progress_bar', 'hide')
+        return True
 
-            self.events.add('percent', 0)
+    def fetch_element(self, element):
+        """ Gets one package, from a cache if possible, downloading it
+            otherwise. Runs inside a worker thread """
+        if self.stop_event.is_set():
+            return False
 
+        with self.lock:
+            self.started += 1
             txt = _("Fetching {0} {1} ({2}/{3})...").format(
-                element['identity'],
-                element['version'],
-                downloaded + 1,
-                total_downloads)
+                element.identity,
+                element.version,
+                self.started,
+                self.total_downloads)
             self.events.add('info', txt)
 
-            dst_path = os.path.join(self.pacman_cache_dir, element['filename'])
-
-            if os.path.exists(dst_path):
-                # File already exists in destination pacman's cache
-                # (previous install?). We check the file hash.
-                if not dhash.check_hash(dst_path, element):
-                    # We're sure it's a wrong hash. Force to download it
-                    needs_to_download = True
-                else:
-                    needs_to_download = False
-                    logging.debug(
-                        "File %s found in %s cache, there is no need to download it",
-                        element['filename'],
-                        self.pacman_cache_dir)
-            else:
-                needs_to_download = True
-                # Check all cache directories
-                for xz_cache_dir in self.xz_cache_dirs:
-                    dst_xz_cache_path = os.path.join(
-                        xz_cache_dir,
-                        element['filename'])
-
-                    if (os.path.exists(dst_xz_cache_path) and
-                            dhash.check_hash(dst_xz_cache_path, element)):
-                        # We're lucky, the package is already downloaded
-                        # in the cache the user has given us
-                        # and its hash checks out
-                        try:
-                            shutil.copy(dst_xz_cache_path, dst_path)
-                            needs_to_download = False
-                            logging.debug(
-                                "%s found in %s cache, there is no need to download it",
-                                element['filename'],
-                                xz_cache_dir)
-                            # Get out of the cache for loop, as we managed
-                            # to find the package in this cache directory
-                            break
-                        except OSError as os_error:
-                            needs_to_download = True
-                            logging.debug(
-                                "Error copying %s to %s : %s",
-                                dst_xz_cache_path,
-                                dst_path,
-                                os_error)
-
-            if needs_to_download and not self.download_package(element, dst_path):
-                # None of the mirror urls works.
-                # Stop right here, so the user does not have to wait
-                # to download the other packages.
-                logging.error(
-                    "Can't download %s, even after trying all available mirrors",
-                    element['filename'])
-                return False
-
-            downloaded += 1
+        dst_path = os.path.join(self.pacman_cache_dir, element.filename)
 
-            self.events.add('progress_bar_show_text', '')
+        if os.path.exists(dst_path):
+            # File already exists in destination pacman's cache
+            # (previous install?). We check the file hash.
+            if not dhash.check_hash(dst_path, element):
+                # We're sure it's a wrong hash. Force to download it
+                needs_to_download = True
+            else:
+                needs_to_download = False
+                logging.debug(
+                    "File %s found in %s cache, there is no need to download it",
+                    element.filename,
+                    self.pacman_cache_dir)
+        else:
+            needs_to_download = True
+            # Check all cache directories
+            for cache_index in self.cache_indexes:
+                dst_xz_cache_path = cache_index.lookup(element)
+
+                if not dst_xz_cache_path:
+                    continue
+
+                # We're lucky, the package is already downloaded
+                # in the cache the user has given us and its hash
+                # checks out
+                method = 'read in place'
+                if self.copy_cached:
+                    try:
+                        method = dcopy.copy_file(dst_xz_cache_path, dst_path)
+                    except OSError as os_error:
+                        logging.debug(
+                            "Error copying %s to %s : %s",
+                            dst_xz_cache_path,
+                            dst_path,
+                            os_error)
+                        continue
+                # Otherwise, pacman will read it from there
+                needs_to_download = False
+                logging.debug(
+                    "%s found in %s cache, there is no need to download it (%s)",
+                    element.filename,
+                    cache_index.cache_dir,
+                    method)
+                # Get out of the cache for loop, as we managed
+                # to find the package in this cache directory
+                break
 
-            downloads_percent = round(float(downloaded / total_downloads), 2)
-            self.events.add('downloads_percent', str(downloads_percent))
+        if not needs_to_download:
+            self.update_progress(self.get_element_size(element))
+            return True
 
-        # Wait until all xz packages are also copied to provided cache (if any)
-        for copy_to_cache_thread in self.copy_to_cache_threads:
-            copy_to_cache_thread.join()
+        if not self.download_package(element, dst_path):
+            if not self.stop_event.is_set():
+                logging.error(
+                    "Can't download %s, even after trying all available mirrors",
+                    element.filename)
+            return False
 
-        self.events.add('downloads_progress_bar', 'hide')
         return True
 
     def download_package(self, element, dst_path):
@@ -207,27 +384,36 @@ class Download():
 
         logging.debug(
             "Looking for %s-%s in %d mirrors...",
-            element['identity'],
-            element['version'],
-            len(element['urls']))
-
-        for url in element['urls']:
+            element.identity,
+            element.version,
+            len(element.urls))
+
+        if self.download_segmented(element, dst_path):
+            # Copy downloaded xz file to the cache the user has provided, too.
+            self.copy_to_cache.add(dst_path)
+            return True
+
+        download_ok = False
+        # Try mirrors that are failing for other packages last
+        urls = self.scoreboard.sort_urls(element.urls)
+        for attempt, url in enumerate(urls):
+            if self.stop_event.is_set():
+                break
             # Let's catch empty values as well as None just to be safe
             if not url:
                 # Something bad has happened, let's try another mirror
                 download_ok = False
                 logging.debug(
                     "Package %s-%s has an empty url for this mirror",
-                    element['identity'],
-                    element['version'])
-            else:
-                download_ok = self.download_url(url, dst_path, element)
+                    element.identity,
+                    element.version)
+                continue
+
+            download_ok = self.download_url(url, dst_path, element)
 
             if download_ok:
                 # Copy downloaded xz file to the cache the user has provided, too.
-                copy_to_cache_thread = CopyToCache(dst_path, self.xz_cache_dirs)
-                copy_to_cache_thread.start()
-                self.copy_to_cache_threads.append(copy_to_cache_thread)
+                self.copy_to_cache.add(dst_path)
 
                 # Get out of the for loop, as we managed
                 # to download the package
@@ -236,67 +422,237 @@ class Download():
                 # requests failed to obtain the file. Wrong url?
                 msg = "Can't download %s, Cnchi will try another mirror."
                 logging.debug(msg, url)
-                # delays for 20 seconds
-                time.sleep(20)
+                if attempt < len(urls) - 1:
+                    # Short random delay (or until another worker fails)
+                    self.stop_event.wait(self.scoreboard.get_backoff(attempt))
 
         return download_ok
 
-    def download_url(self, url, dst_path, element=None):
-        """ Downloads file from url to dst_path and checks its md5 hash """
-        percent = 0
+    def download_segmented(self, element, dst_path):
+        """ Downloads a big package splitting it in byte ranges that are
+            fetched in parallel from several of its mirrors.
+            Returns False if the package is too small, there are not enough
+            mirrors or the segmented download fails """
+        size = self.get_element_size(element)
+        # Failing mirrors would slow down the whole package
+        urls = [
+            url for url in self.scoreboard.sort_urls(element.urls)
+            if url and not self.scoreboard.is_demoted(url)]
+        urls = urls[:Download.MAX_SEGMENT_MIRRORS]
+
+        if size < Download.SEGMENTED_MIN_SIZE or len(urls) < 2:
+            return False
+
+        if os.path.exists(dst_path + Download.PART_SUFFIX):
+            # Resuming a previous download is better
+            return False
+
+        segments_path = dst_path + Download.SEGMENTS_SUFFIX
+
+        logging.debug(
+            "Downloading %s in segments from %d mirrors",
+            element.filename,
+            len(urls))
+
+        segments = collections.deque(
+            (start, min(start + Download.SEGMENT_SIZE, size) - 1)
+            for start in range(0, size, Download.SEGMENT_SIZE))
+        num_segments = len(segments)
+        done = []
+
+        try:
+            with open(segments_path, 'wb') as xz_file:
+                xz_file.truncate(size)
+                xz_fd = xz_file.fileno()
+
+                def worker(url):
+                    """ Fetches segments from url until none is left
+                        or the mirror fails """
+                    while not self.stop_event.is_set():
+                        try:
+                            segment = segments.popleft()
+                        except IndexError:
+                            return
+                        if not self.download_range(url, xz_fd, *segment):
+                            # Let another mirror fetch this range
+                            segments.append(segment)
+                            return
+                        done.append(segment)
+
+                workers = []
+                for url in urls:
+                    my_thread = threading.Thread(target=worker, args=(url,))
+                    my_thread.start()
+                    workers.append(my_thread)
+
+                for my_thread in workers:
+                    my_thread.join()
+        except OSError as os_error:
+            logging.debug(os_error)
+            done = []
+
+        if len(done) != num_segments or not dhash.check_hash(segments_path, element):
+            logging.debug(
+                "Segmented download of %s failed, trying one mirror at a time",
+                element.filename)
+            self.update_progress(-sum(end - start + 1 for start, end in done))
+            try:
+                os.remove(segments_path)
+            except OSError:
+                pass
+            return False
+
+        try:
+            os.rename(segments_path, dst_path)
+        except OSError as os_error:
+            logging.debug(os_error)
+            return False
+        return True
+
+    def download_range(self, url, xz_fd, start, end):
+        """ Downloads bytes start-end (both included) from url and writes them
+            at the same position in the file xz_fd """
         completed_length = 0
-        start = time.perf_counter()
+        headers = {'Range': 'bytes={0}-{1}'.format(start, end)}
         try:
-            # By default, get waits five minutes before
-            # issuing a timeout, which is too much.
-            if self.proxies:
-                req = requests.get(
-                    url,
-                    stream=True,
-                    timeout=30,
-                    proxies=self.proxies)
-            else:
-                req = requests.get(
-                    url,
-                    stream=True,
-                    timeout=30)
-
-            if req.status_code == requests.codes.ok:
-                # Get total file length
-                try:
-                    total_length = int(req.headers.get('content-length'))
-                except TypeError:
-                    total_length = 0
-                    logging.debug(
-                        "Metalink for package %s has no size info", url)
-
-                with open(dst_path, 'wb') as xz_file:
+            with self.get_host_slot(url):
+                time0 = time.perf_counter()
+                with self.sessions.get(url, headers=headers, stream=True, timeout=30) as req:
+                    if req.status_code != requests.codes.partial_content:
+                        # Mirror does not support ranges
+                        logging.debug("%s returned status code %d", url, req.status_code)
+                        if req.status_code != requests.codes.ok:
+                            self.scoreboard.record_failure(url)
+                        return False
+
                     for data in req.iter_content(io.DEFAULT_BUFFER_SIZE):
                         if not data:
                             break
-                        xz_file.write(data)
+                        if self.stop_event.is_set():
+                            break
+                        os.pwrite(xz_fd, data, start + completed_length)
                         completed_length += len(data)
-                        old_percent = percent
-                        if total_length > 0:
-                            percent = float(completed_length / total_length)
-                            percent = round(percent, 2)
-                        else:
-                            percent += 0.1
-                        if old_percent != percent:
-                            self.events.add('percent', percent)
-                        bps = completed_length // (time.perf_counter() - start)
-                        msg = self.format_progress_message(percent, bps)
-                        self.events.add('progress_bar_show_text', msg)
-
-                # Check hash of downloaded package
-                if element and not dhash.check_hash(dst_path, element):
-                    # Wrong hash! Force to download the file again
+                        self.update_progress(len(data), len(data))
+        except (socket.timeout,
+                requests.exceptions.Timeout) as timeout_error:
+            logging.debug(timeout_error)
+            self.scoreboard.record_failure(url, timeout=True)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                OSError) as connection_error:
+            logging.debug(connection_error)
+            self.scoreboard.record_failure(url)
+
+        if completed_length != end - start + 1:
+            self.update_progress(-completed_length)
+            return False
+        self.scoreboard.record_success(url, completed_length, time.perf_counter() - time0)
+        return True
+
+    def download_url(self, url, dst_path, element=None):
+        """ Downloads file from url to dst_path and checks its md5 hash
+            Data is written to dst_path.part, which is resumed (if it exists)
+            and only renamed to dst_path when its hash is correct """
+        part_path = dst_path + Download.PART_SUFFIX
+        completed_length = 0
+        try:
+            offset = os.path.getsize(part_path)
+        except OSError:
+            offset = 0
+
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+
+        try:
+            with self.get_host_slot(url):
+                if self.stop_event.is_set():
                     return False
+
+                # By default, get waits five minutes before
+                # issuing a timeout, which is too much.
+                time0 = time.perf_counter()
+                with self.sessions.get(
+                        url, headers=headers, stream=True, timeout=30) as req:
+                    if offset > 0 and req.status_code == requests.codes.partial_content:
+                        logging.debug(
+                            "Resuming %s from byte %d", os.path.basename(dst_path), offset)
+                        mode = 'ab'
+                    elif (offset > 0 and
+                          req.status_code == requests.codes.range_not_satisfiable):
+                        # Part file is already complete (or it is wrong,
+                        # the hash check will tell us)
+                        mode = None
+                    elif req.status_code == requests.codes.ok:
+                        # Server ignored our range (or there was none)
+                        mode = 'wb'
+                        offset = 0
+                    else:
+                        logging.debug("%s returned status code %d", url, req.status_code)
+                        self.scoreboard.record_failure(url)
+                        return False
+
+                    completed_length = offset
+                    self.update_progress(offset)
+
+                    if element and mode:
+                        # Hash data while it is downloaded
+                        stream_hash = dhash.StreamHash(element)
+                        if mode == 'ab':
+                            stream_hash.update_from_file(part_path)
+                    else:
+                        stream_hash = None
+
+                    if mode:
+                        with open(part_path, mode) as xz_file:
+                            for data in req.iter_content(io.DEFAULT_BUFFER_SIZE):
+                                if not data:
+                                    break
+                                if self.stop_event.is_set():
+                                    # Another package failed, do not waste time
+                                    self.update_progress(-completed_length)
+                                    return False
+                                xz_file.write(data)
+                                if stream_hash:
+                                    stream_hash.update(data)
+                                completed_length += len(data)
+                                self.update_progress(len(data), len(data))
+
+            # Check hash of downloaded package
+            if stream_hash:
+                hash_ok = stream_hash.check()
+            elif element:
+                hash_ok = dhash.check_hash(part_path, element)
+            else:
+                hash_ok = True
+
+            if not hash_ok:
+                # Wrong hash! Force to download the file again
+                self.update_progress(-completed_length)
+                self.scoreboard.record_failure(url)
+                os.remove(part_path)
+                return False
+
+            os.rename(part_path, dst_path)
+            self.scoreboard.record_success(
+                url, completed_length - offset, time.perf_counter() - time0)
         except (socket.timeout,
-                requests.exceptions.Timeout,
-                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as timeout_error:
+            # Keep the part file, next mirror will resume it
+            logging.debug(timeout_error)
+            self.update_progress(-completed_length)
+            self.scoreboard.record_failure(url, timeout=True)
+            return False
+        except (requests.exceptions.ConnectionError,
                 requests.exceptions.ChunkedEncodingError) as connection_error:
+            # Keep the part file, next mirror will resume it
             logging.debug(connection_error)
+            self.update_progress(-completed_length)
+            self.scoreboard.record_failure(url)
+            return False
+        except OSError as os_error:
+            logging.debug(os_error)
+            self.update_progress(-completed_length)
             return False
 
         return True
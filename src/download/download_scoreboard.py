@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# download_scoreboard.py
+#
+# Copyright © 2013-2018 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Live health information of the mirrors used to download packages """
+
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+
+class MirrorStats():
+    """ Stores what has happened with one mirror """
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.consecutive_failures = 0
+        self.transferred = 0
+        self.seconds = 0.0
+        self.demoted_until = 0.0
+
+    def get_rate(self):
+        """ Returns mirror throughput (bytes per second) """
+        if self.seconds > 0:
+            return self.transferred / self.seconds
+        return 0
+
+
+class MirrorScoreboard():
+    """ Shared by all download workers. Records failures and timeouts of
+        each mirror host, so mirrors that fail are tried last by all packages
+        downloaded afterwards (and are not used for segmented downloads).
+        Throughput is only logged """
+
+    # Consecutive failures after which a mirror is demoted
+    MAX_FAILURES = 2
+    # Seconds a demoted mirror stays at the end of the list
+    DEMOTE_TIME = 120
+    # Backoff (in seconds) after a failed mirror: BACKOFF_BASE * 2^attempt,
+    # never more than BACKOFF_MAX, plus/minus 50% jitter
+    BACKOFF_BASE = 0.25
+    BACKOFF_MAX = 4
+
+    def __init__(self):
+        self.mirrors = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_host(url):
+        """ Returns mirror host of url """
+        return urllib.parse.urlsplit(url).netloc
+
+    def get_stats(self, host):
+        """ Returns host stats (call it with the lock held) """
+        stats = self.mirrors.get(host)
+        if stats is None:
+            stats = MirrorStats()
+            self.mirrors[host] = stats
+        return stats
+
+    def record_success(self, url, transferred, seconds):
+        """ Stores a good download from url """
+        with self.lock:
+            stats = self.get_stats(self.get_host(url))
+            stats.successes += 1
+            stats.consecutive_failures = 0
+            stats.demoted_until = 0.0
+            stats.transferred += transferred
+            stats.seconds += seconds
+
+    def record_failure(self, url, timeout=False):
+        """ Stores a failed download from url """
+        host = self.get_host(url)
+        with self.lock:
+            stats = self.get_stats(host)
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if timeout:
+                stats.timeouts += 1
+            if stats.consecutive_failures >= MirrorScoreboard.MAX_FAILURES:
+                if stats.demoted_until < time.monotonic():
+                    logging.debug("Mirror %s has been demoted", host)
+                stats.demoted_until = time.monotonic() + MirrorScoreboard.DEMOTE_TIME
+
+    def is_demoted(self, url):
+        """ True if url's mirror is failing """
+        with self.lock:
+            stats = self.mirrors.get(self.get_host(url))
+            return bool(stats and stats.demoted_until > time.monotonic())
+
+    def sort_urls(self, urls):
+        """ Returns urls with demoted mirrors (and mirrors that have just
+            failed) at the end. Otherwise the original order is kept """
+        now = time.monotonic()
+        with self.lock:
+            def sort_key(url):
+                """ (demoted, consecutive failures) """
+                stats = self.mirrors.get(self.get_host(url)) if url else None
+                if stats is None:
+                    return (False, 0)
+                return (stats.demoted_until > now, stats.consecutive_failures)
+            return sorted(urls, key=sort_key)
+
+    @staticmethod
+    def get_backoff(attempt):
+        """ Seconds to wait before trying the next mirror """
+        delay = min(
+            MirrorScoreboard.BACKOFF_MAX,
+            MirrorScoreboard.BACKOFF_BASE * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.5)
+
+    def log_stats(self):
+        """ Logs the scoreboard """
+        with self.lock:
+            for host, stats in sorted(self.mirrors.items()):
+                logging.debug(
+                    "%s: %d ok, %d failed (%d timeouts), %.2f KiB/s",
+                    host,
+                    stats.successes,
+                    stats.failures,
+                    stats.timeouts,
+                    stats.get_rate() / 1024)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# download_session.py
+#
+# Copyright © 2013-2018 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Pool of keep-alive http sessions (one per mirror host) """
+
+import collections
+import logging
+import threading
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool():
+    """ Stores one requests session per mirror host, so packages downloaded
+        from the same mirror reuse its TCP connections (and TLS handshakes) """
+
+    def __init__(self, proxies=None, max_connections_per_host=2):
+        self.proxies = proxies
+        self.max_connections_per_host = max_connections_per_host
+        self.sessions = {}
+        self.requests_count = collections.Counter()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_host(url):
+        """ Returns scheme and host part of url (the session key) """
+        parts = urllib.parse.urlsplit(url)
+        return "{0}://{1}".format(parts.scheme, parts.netloc)
+
+    def get_session(self, url):
+        """ Returns url's host session (creates it if necessary) """
+        host = self.get_host(url)
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.max_connections_per_host)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                if self.proxies:
+                    session.proxies.update(self.proxies)
+                self.sessions[host] = session
+            self.requests_count[host] += 1
+        return session
+
+    def get(self, url, **kwargs):
+        """ Issues a GET request using url's host session """
+        return self.get_session(url).get(url, **kwargs)
+
+    @staticmethod
+    def count_connections(session):
+        """ Returns how many connections have been opened by session """
+        num_connections = 0
+        # The same adapter is mounted for both http and https
+        adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+        for adapter in adapters.values():
+            managers = [adapter.poolmanager]
+            managers.extend(adapter.proxy_manager.values())
+            for manager in managers:
+                for key in manager.pools.keys():
+                    pool = manager.pools.get(key)
+                    if pool is not None:
+                        num_connections += pool.num_connections
+        return num_connections
+
+    def get_stats(self):
+        """ Returns a dict with requests, new connections and reused
+            connections for each host """
+        stats = {}
+        with self.lock:
+            for host, session in self.sessions.items():
+                num_requests = self.requests_count[host]
+                num_connections = self.count_connections(session)
+                stats[host] = {
+                    'requests': num_requests,
+                    'connections': num_connections,
+                    'reused': max(num_requests - num_connections, 0)}
+        return stats
+
+    def log_stats(self):
+        """ Logs how many connections (handshakes) have been saved """
+        stats = self.get_stats()
+        total_reused = 0
+        for host, host_stats in sorted(stats.items()):
+            logging.debug(
+                "%s: %d requests, %d connections, %d reused",
+                host,
+                host_stats['requests'],
+                host_stats['connections'],
+                host_stats['reused'])
+            total_reused += host_stats['reused']
+        if stats:
+            logging.debug(
+                "%d connections have been reused (from %d hosts)",
+                total_reused, len(stats))
+
+    def close(self):
+        """ Closes all sessions """
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
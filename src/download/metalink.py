@@ -30,11 +30,10 @@
 
 """ Operations with metalinks """
 
+import io
 import logging
-import tempfile
 import os
 
-import hashlib
 import re
 import argparse
 
@@ -43,65 +42,73 @@ from collections import deque
 from xml.dom.minidom import getDOMImplementation
 import xml.etree.cElementTree as elementTree
 
-import pyalpm
+try:
+    import download.download_hash as dhash
+    from download.download_plan import DownloadItem
+except ModuleNotFoundError:
+    import download_hash as dhash
+    from download_plan import DownloadItem
 
 MAX_URLS = 15
 
 
 def get_info(metalink):
-    """ Reads metalink xml info and returns it """
+    """ Reads metalink xml info (a Metalink object or a xml string)
+        and returns it as a download plan """
 
     # tag = "{urn:ietf:params:xml:ns:metalink}"
 
-    temp_file = tempfile.NamedTemporaryFile(delete=False)
-    temp_file.write(str(metalink).encode('UTF-8'))
-    temp_file.close()
+    xml_file = io.BytesIO(str(metalink).encode('UTF-8'))
 
-    metalink_info = {}
+    download_plan = {}
     element = {}
 
-    for event, elem in elementTree.iterparse(temp_file.name, events=('start', 'end')):
+    for event, elem in elementTree.iterparse(xml_file, events=('start', 'end')):
         if event == 'start':
             tag = elem.tag.split('}')[1]
             if tag == 'file':
                 element['filename'] = elem.attrib['name']
             elif tag == 'hash':
-                hash_type = elem.attrib['type']
-                try:
-                    element['hash'][hash_type] = elem.text
-                except KeyError:
-                    element['hash'] = {hash_type: elem.text}
+                if elem.attrib['type'] in ('sha256', 'md5'):
+                    element[elem.attrib['type']] = elem.text
             elif tag == 'url':
+                element.setdefault('urls', []).append(elem.text)
+            elif tag == 'size':
+                # Same type as in plans created from pyalpm packages
                 try:
-                    element['urls'].append(elem.text)
-                except KeyError:
-                    element['urls'] = [elem.text]
-            else:
+                    element['size'] = int(elem.text)
+                except (TypeError, ValueError):
+                    element['size'] = 0
+            elif tag in ('identity', 'version', 'description'):
                 element[tag] = elem.text
         if event == 'end' and elem.tag.endswith('file'):
             # Limit to MAX_URLS for each file
-            if len(element['urls']) > MAX_URLS:
-                element['urls'] = element['urls'][:MAX_URLS]
-            key = element['identity']
-            metalink_info[key] = element.copy()
+            element['urls'] = element.get('urls', [])[:MAX_URLS]
+            element.setdefault('identity', element['filename'])
+            item = DownloadItem(**element)
+            download_plan[item.identity] = item
             element.clear()
             elem.clear()
 
-    if os.path.exists(temp_file.name):
-        os.remove(temp_file.name)
+    return download_plan
 
-    return metalink_info
 
+def create(alpm, package_names, pacman_conf_file):
+    """ Creates a download plan (a dict of DownloadItem objects) to download
+        package_names and their dependencies.
+        package_names can be a single name or a list of names. All of them
+        are resolved together (just one dependency resolution pass) """
 
-def create(alpm, package_name, pacman_conf_file):
-    """ Creates a metalink to download package_name and its dependencies """
+    if isinstance(package_names, str):
+        package_names = [package_names]
 
     options = ["--conf", pacman_conf_file, "--noconfirm", "--all-deps"]
 
-    if package_name == "databases":
+    if package_names == ["databases"]:
         options.append("--refresh")
     else:
-        options.append(package_name)
+        options.append("--")
+        options.extend(package_names)
 
     download_queue, not_found, missing_deps = build_download_queue(
         alpm, args=options)
@@ -119,26 +126,56 @@ def create(alpm, package_name, pacman_conf_file):
         return None
 
     if download_queue:
-        metalink = download_queue_to_metalink(download_queue)
-        return metalink
+        return download_queue_to_plan(download_queue)
 
-    logging.error("Unable to create download queue for package %s", package_name)
+    logging.error(
+        "Unable to create download queue for package(s) %s", ' '.join(package_names))
     return None
 
 # From here comes modified code from pm2ml
 # pm2ml is Copyright (C) 2012-2013 Xyne
 # More info: http://xyne.archlinux.ca/projects/pm2ml
 
-def download_queue_to_metalink(download_queue):
-    """ Converts a download_queue object to a metalink """
-    metalink = Metalink()
+def download_queue_to_plan(download_queue):
+    """ Converts a download_queue object to a download plan """
+    download_plan = {}
+
+    def add_item(item):
+        """ Adds item to the plan """
+        download_plan[item.identity] = item
+
+    def add_sig(item):
+        """ Adds the signature file of item to the plan """
+        filename = item.filename + '.sig'
+        add_item(DownloadItem(
+            identity=filename,
+            filename=filename,
+            urls=[url + '.sig' for url in item.urls]))
 
     for database, sigs in download_queue.dbs:
-        metalink.add_db(database, sigs)
+        filename = database.name + '.db'
+        item = DownloadItem(
+            identity=filename,
+            filename=filename,
+            urls=[os.path.join(url, filename) for url in database.servers])
+        add_item(item)
+        if sigs:
+            add_sig(item)
 
     for pkg, urls, sigs in download_queue.sync_pkgs:
-        metalink.add_sync_pkg(pkg, urls, sigs)
+        item = DownloadItem.from_pkg(pkg, urls)
+        add_item(item)
+        if sigs:
+            add_sig(item)
+
+    return download_plan
 
+
+def plan_to_metalink(download_plan):
+    """ Converts a download plan to a metalink (optional xml export) """
+    metalink = Metalink()
+    for item in download_plan.values():
+        metalink.add_item(item)
     return metalink
 
 
@@ -171,47 +208,28 @@ class Metalink():
             url_val = self.doc.createTextNode(url)
             url_tag.appendChild(url_val)
 
-    def add_sync_pkg(self, pkg, urls, sigs=False):
-        """Add a sync db package."""
+    def add_item(self, item):
+        """Add a download plan item."""
         file_ = self.doc.createElement("file")
-        file_.setAttribute("name", pkg.filename)
+        file_.setAttribute("name", item.filename)
         self.files.appendChild(file_)
-        for tag, db_attr, attrs in (
-                ('identity', 'name', ()),
+        for tag, attr, attrs in (
+                ('identity', 'identity', ()),
                 ('size', 'size', ()),
                 ('version', 'version', ()),
-                ('description', 'desc', ()),
-                ('hash', 'sha256sum', (('type', 'sha256'),)),
-                ('hash', 'md5sum', (('type', 'md5'),))):
+                ('description', 'description', ()),
+                ('hash', 'sha256', (('type', 'sha256'),)),
+                ('hash', 'md5', (('type', 'md5'),))):
+            value = getattr(item, attr)
+            if value is None:
+                continue
             tag = self.doc.createElement(tag)
             file_.appendChild(tag)
-            val = self.doc.createTextNode(str(getattr(pkg, db_attr)))
+            val = self.doc.createTextNode(str(value))
             tag.appendChild(val)
             for key, val in attrs:
                 tag.setAttribute(key, val)
-        urls = list(urls)
-        self.add_urls(file_, urls)
-        if sigs:
-            self.add_file(pkg.filename + '.sig', (u + '.sig' for u in urls))
-
-    def add_file(self, name, urls):
-        """Add a signature file."""
-        file_ = self.doc.createElement("file")
-        file_.setAttribute("name", name)
-        self.files.appendChild(file_)
-        self.add_urls(file_, urls)
-
-    def add_db(self, database, sigs=False):
-        """Add a sync db."""
-        file_ = self.doc.createElement("file")
-        name = database.name + '.db'
-        file_.setAttribute("name", name)
-        self.files.appendChild(file_)
-        urls = list(os.path.join(url, database.name + '.db')
-                    for url in database.servers)
-        self.add_urls(file_, urls)
-        if sigs:
-            self.add_file(name + '.sig', (u + '.sig' for u in urls))
+        self.add_urls(file_, item.urls)
 
 
 class PkgSet():
@@ -338,27 +356,30 @@ def get_antergos_repo_pkgs(alpm_handle):
     return repo_pkgs, antdb
 
 
-def resolve_deps(alpm_handle, other, alldeps):
-    """ Resolve dependencies """
+def resolve_deps(alpm_handle, other, alldeps, sync_index=None):
+    """ Resolve dependencies of all packages in other at once. A package
+        shared by several requested packages is only resolved one time.
+        sync_index (pacman.sync_index.SyncIndex) caches which package
+        satisfies each dependency string """
+    if sync_index is None:
+        from pacman.sync_index import SyncIndex
+        sync_index = SyncIndex(alpm_handle)
     missing_deps = []
     queue = deque(other)
-    local_cache = alpm_handle.get_localdb().pkgcache
-    syncdbs = alpm_handle.get_syncdbs()
-    seen = set(queue)
+    seen = set(pkg.name for pkg in queue)
     while queue:
         pkg = queue.popleft()
         for dep in pkg.depends:
-            if pyalpm.find_satisfier(local_cache, dep) is None or alldeps:
-                for database in syncdbs:
-                    prov = pyalpm.find_satisfier(database.pkgcache, dep)
-                    if prov:
-                        other.add(prov)
-                        if prov.name not in seen:
-                            seen.add(prov.name)
-                            queue.append(prov)
-                        break
+            if alldeps or not sync_index.is_installed(dep):
+                prov = sync_index.find_satisfier(dep)
+                if prov:
+                    other.add(prov)
+                    if prov.name not in seen:
+                        seen.add(prov.name)
+                        queue.append(prov)
                 else:
                     missing_deps.append(dep)
+    sync_index.log_stats()
     return other, missing_deps
 
 
@@ -392,7 +413,8 @@ def create_package_set(requested, ant_repo_pkgs, antdb, alpm_handle):
 
 def build_download_queue(alpm, args=None):
     """ Function to build a download queue.
-        Needs a pkgname in args """
+        Needs one or more pkgnames in args (all of them are
+        resolved together in a single download queue) """
 
     pargs = parse_args(args)
 
@@ -415,7 +437,8 @@ def build_download_queue(alpm, args=None):
 
     # Resolve dependencies.
     if other and not pargs.nodeps:
-        other, missing_deps = resolve_deps(handle, other, pargs.alldeps)
+        other, missing_deps = resolve_deps(
+            handle, other, pargs.alldeps, alpm.get_sync_index())
 
     found |= set(other.pkgs)
     not_found = requested - found
@@ -458,37 +481,27 @@ def build_download_queue(alpm, args=None):
     return download_queue, not_found, missing_deps
 
 
-def get_checksum(path, typ):
-    """ Returns checksum of a file """
-    new_hash = hashlib.new(typ)
-    block_size = new_hash.block_size
-    try:
-        with open(path, 'rb') as myfile:
-            buf = myfile.read(block_size)
-            while buf:
-                new_hash.update(buf)
-                buf = myfile.read(block_size)
-        return new_hash.hexdigest()
-    except FileNotFoundError:
-        return -1
-    except IOError as io_error:
-        logging.error(io_error)
-
-
 def check_cache(conf, pkgs):
-    """ Checks package checksum in cache """
+    """ Yields packages that are not in any cache dir (or whose
+        checksum is wrong). Cached files are checked in parallel """
+    pkgs = list(pkgs)
+    needed = set(pkg.name for pkg in pkgs)
+    candidates = []
     for pkg in pkgs:
+        element = DownloadItem.from_pkg(pkg, [])
         for cache in conf.options['CacheDir']:
             fpath = os.path.join(cache, pkg.filename)
-            for checksum in ('sha256', 'md5'):
-                real_checksum = get_checksum(fpath, checksum)
-                correct_checksum = getattr(pkg, checksum + 'sum')
-                if real_checksum is None or real_checksum != correct_checksum:
-                    yield pkg
-                    break
-            else:
-                continue
-            break
+            if os.path.exists(fpath):
+                candidates.append((fpath, element))
+
+    results = dhash.check_hashes(candidates)
+    for (_fpath, element), hash_ok in zip(candidates, results):
+        if hash_ok:
+            needed.discard(element.identity)
+
+    for pkg in pkgs:
+        if pkg.name in needed:
+            yield pkg
 
 
 def needs_sig(siglevel, insistence, prefix):
@@ -536,17 +549,18 @@ def test_module():
         conf_path="/etc/pacman.conf",
         callback_queue=None)
 
-    print("Creating metalink...")
-    meta4 = create(
+    print("Creating download plan...")
+    download_plan = create(
         alpm=pacman,
-        #package_name="ipw2200-fw",
-        package_name="base-devel",
+        #package_names=["ipw2200-fw"],
+        package_names=["base-devel"],
         pacman_conf_file="/etc/pacman.conf")
-    #print(meta4)
-    #print('=' * 20)
-    if meta4:
+    if download_plan:
+        meta4 = plan_to_metalink(download_plan)
+        #print(meta4)
+        #print('=' * 20)
         print(get_info(meta4))
-    # print(get_info(meta4)['ipw2200-fw']['urls'])
+    # print(download_plan['ipw2200-fw'].urls)
 
     pacman.release()
     del pacman
@@ -43,6 +43,7 @@ from misc.extra import InstallError
 from misc.run_cmd import call
 from misc.events import Events
 import pacman.pac as pac
+import pacman.alpm_session as alpm_session
 
 import hardware.hardware as hardware
 
@@ -369,7 +370,8 @@ class Installation():
         file_rendered = file_template.render(
             destDir=DEST_DIR,
             arch=myarch,
-            desktop=self.desktop)
+            desktop=self.desktop,
+            cacheDirs=self.settings.get('xz_cache') or [])
         filename = Installation.TMP_PACMAN_CONF
         dirname = os.path.dirname(filename)
         os.makedirs(dirname, mode=0o755, exist_ok=True)
@@ -387,8 +389,9 @@ class Installation():
 
         # Init pyalpm
         try:
-            self.pacman = pac.Pac(
+            session = alpm_session.get_session(
                 Installation.TMP_PACMAN_CONF, self.events.queue)
+            self.pacman = session.pacman
         except Exception as ex:
             self.pacman = None
             template = ("Can't initialize pyalpm. "
@@ -397,8 +400,8 @@ class Installation():
             logging.error(message)
             raise InstallError(message)
 
-        # Refresh pacman databases
-        if not self.pacman.refresh():
+        # Refresh pacman databases (if they are not up to date)
+        if not session.refresh(proxies=self.settings.get('proxies')):
             logging.error("Can't refresh pacman databases.")
             raise InstallError(_("Can't refresh pacman databases."))
 
@@ -471,10 +474,10 @@ class Installation():
     def install_packages(self):
         """ Start pacman installation of packages """
         result = False
-        # This shouldn't be necessary if download.py really downloaded all
-        # needed packages, but it does not do it (why?)
-        for cache_dir in self.settings.get('xz_cache'):
-            self.pacman.handle.add_cachedir(cache_dir)
+
+        # xz cache directories (the ISO cache, too) are already pacman
+        # CacheDirs (see create_pacman_conf_file), download.py does not
+        # copy packages found there
 
         logging.debug("Installing packages...")
 
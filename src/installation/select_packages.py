@@ -26,7 +26,6 @@
 
 import logging
 import os
-import subprocess
 import requests
 from requests.exceptions import RequestException
 
@@ -34,7 +33,7 @@ import xml.etree.cElementTree as elementTree
 
 import desktop_info
 
-import pacman.pac as pac
+import pacman.alpm_session as alpm_session
 
 from misc.events import Events
 import misc.extra as misc
@@ -74,6 +73,9 @@ class SelectPackages():
 
         self.xml_root = None
 
+        # Pac object (alpm handle) used to check packages
+        self.pacman = None
+
         # If Lembrame enabled set pacman.conf pointing to the decrypted folder
         if self.settings.get('feature_lembrame'):
             self.lembrame = Lembrame(self.settings)
@@ -91,7 +93,10 @@ class SelectPackages():
         logging.debug("Pacman ready")
 
         logging.debug("Selecting packages...")
-        self.select_packages()
+        try:
+            self.select_packages()
+        finally:
+            self.release_pacman()
         logging.debug("Packages selected")
 
         # Fix bug #263 (v86d moved from [extra] to AUR)
@@ -104,10 +109,11 @@ class SelectPackages():
 
     @misc.raise_privileges
     def refresh_pacman_databases(self):
-        """ Updates pacman databases """
+        """ Updates pacman databases (if they are not up to date) """
         # Init pyalpm
         try:
-            pacman = pac.Pac(self.settings.get('pacman_config_file'), self.events.queue)
+            session = alpm_session.get_session(
+                self.settings.get('pacman_config_file'), self.events.queue)
         except Exception as ex:
             template = (
                 "Can't initialize pyalpm. An exception of type {0} occured. Arguments:\n{1!r}")
@@ -116,20 +122,18 @@ class SelectPackages():
             raise InstallError(message)
 
         # Refresh pacman databases
-        if not pacman.refresh():
+        if not session.refresh(proxies=self.settings.get('proxies')):
             logging.error("Can't refresh pacman databases.")
             txt = _("Can't refresh pacman databases.")
             raise InstallError(txt)
 
-        try:
-            pacman.release()
-            del pacman
-        except Exception as ex:
-            template = (
-                "Can't release pyalpm. An exception of type {0} occured. Arguments:\n{1!r}")
-            message = template.format(type(ex).__name__, ex.args)
-            logging.error(message)
-            raise InstallError(message)
+        # Keep it, it will be used to check packages
+        self.pacman = session.pacman
+
+    def release_pacman(self):
+        """ Stops using alpm handle (it stays open in its session,
+            so it can be used again later) """
+        self.pacman = None
 
     def add_package(self, pkg):
         """ Adds xml node text to our package list
@@ -368,24 +372,18 @@ class SelectPackages():
 
     def check_packages(self):
         """ Checks that all selected packages ARE in the repositories """
-        not_found = []
         self.events.add('percent', 0)
         self.events.add('info', _("Checking that all selected packages are available online..."))
-        num_pkgs = len(self.packages)
-        for index, pkg_name in enumerate(self.packages):
-            # TODO: Use libalpm instead
-            cmd = ["/usr/bin/pacman", "-Ss", pkg_name]
-            try:
-                output = subprocess.check_output(cmd).decode()
-            except subprocess.CalledProcessError:
-                output = ""
-
-            if pkg_name not in output:
-                not_found.append(pkg_name)
-                logging.error("Package %s...NOT FOUND!", pkg_name)
-
-            percent = (index + 1) / num_pkgs
-            self.events.add('percent', percent)
+        if self.pacman is None:
+            self.pacman = alpm_session.get_session(
+                self.settings.get('pacman_config_file'), self.events.queue).pacman
+        sync_index = self.pacman.get_sync_index()
+
+        # Package names, provides and groups (exact matches)
+        not_found = sync_index.find_missing(self.packages)
+        for pkg_name in not_found:
+            logging.error("Package %s...NOT FOUND!", pkg_name)
+        self.events.add('percent', 1)
 
         if not_found:
             txt = _("Cannot find these packages: {}").format(', '.join(not_found))
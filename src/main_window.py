@@ -127,6 +127,10 @@ class MainWindow(Gtk.ApplicationWindow):
         # Store cache dirs in config
         self.settings.set('xz_cache', xz_cache)
 
+        # Export download plan (debugging)
+        if cmd_line.metalink:
+            self.settings.set('metalink_file', cmd_line.metalink)
+
         data_dir = self.settings.get('data')
 
         # For things we are not ready for users to test
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# mirrorlist.py
+#
+# Copyright © 2013-2018 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+""" Mirrorlist files (parsed only once while they do not change) """
+
+import logging
+import os
+import threading
+
+# Parsed mirrorlists (path: Mirrorlist)
+_MIRRORLISTS = {}
+_LOCK = threading.Lock()
+
+
+def get_host(url):
+    """ Returns the first part of the URL (scheme and host) """
+    return '/'.join(url.split('/')[:3])
+
+
+def parse_server_line(line):
+    """ Returns (url, active) from a 'Server = url' or '#Server = url'
+        line. Returns None if it is not a server line """
+    line = line.strip()
+    active = not line.startswith('#')
+    line = line.lstrip('#').strip()
+    if not line.startswith('Server') or '=' not in line:
+        return None
+    url = line.split('=', 1)[1].strip()
+    if not url:
+        return None
+    return url, active
+
+
+def trim_url(url):
+    """ Removes the repository part of an Arch mirror url """
+    return url.replace("/$repo/os/$arch", "")
+
+
+class Mirrorlist():
+    """ Servers of a mirrorlist file, in file order, indexed by url and host """
+
+    def __init__(self, path, stamp=None):
+        self.path = path
+        # (mtime, size) of the parsed file
+        self.stamp = stamp
+        # List of (url, active)
+        self.servers = []
+        # url: position
+        self.positions = {}
+        # host: url (first one of each host)
+        self.hosts = {}
+
+    def load(self):
+        """ Reads mirrorlist file """
+        try:
+            with open(self.path, 'r') as mirrorlist_file:
+                for line in mirrorlist_file:
+                    server = parse_server_line(line)
+                    if server and server[0] not in self.positions:
+                        self.positions[server[0]] = len(self.servers)
+                        self.servers.append(server)
+                        self.hosts.setdefault(get_host(server[0]), server[0])
+        except OSError as err:
+            logging.warning("Can't read %s: %s", self.path, err)
+
+    def get_urls(self, active_only=True):
+        """ Returns servers urls (in file order) """
+        return [url for url, active in self.servers if active or not active_only]
+
+    def find_url(self, mirror_url):
+        """ Returns the full url of the server that matches mirror_url
+            (a mirror address without repository part). None if not found """
+        host = get_host(mirror_url)
+        if host == mirror_url.rstrip('/'):
+            return self.hosts.get(host)
+        for url, _active in self.servers:
+            if mirror_url in url:
+                return url
+        return None
+
+
+def get_mirrorlist(path):
+    """ Returns the parsed mirrorlist file. It is only parsed again if the
+        file has changed (different mtime or size) """
+    try:
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        stamp = None
+
+    with _LOCK:
+        mirrorlist = _MIRRORLISTS.get(path)
+        if mirrorlist is None or mirrorlist.stamp != stamp:
+            mirrorlist = Mirrorlist(path, stamp)
+            if stamp is not None:
+                mirrorlist.load()
+            _MIRRORLISTS[path] = mirrorlist
+        return mirrorlist
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  alpm_session.py
+#
+#  Copyright © 2013-2018 Antergos
+#
+#  This file is part of Cnchi.
+#
+#  Cnchi is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Cnchi is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  The following additional terms are in effect as per Section 7 of the license:
+#
+#  The preservation of all legal notices and author attributions in
+#  the material or in the Appropriate Legal Notices displayed
+#  by works containing it is required.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Long lived alpm handles, shared by all installation phases """
+
+import json
+import logging
+import os
+import threading
+import time
+
+from misc.events import Events
+
+import pacman.pac as pac
+from download.download_databases import DatabaseRefresh
+
+# Sync databases updated less than REFRESH_MAX_AGE seconds ago are not
+# downloaded again
+REFRESH_MAX_AGE = 30 * 60
+
+# Stored in the sync databases directory
+REFRESH_STAMP = '.cnchi-refresh'
+
+# pacman.conf path: AlpmSession
+_SESSIONS = {}
+_LOCK = threading.Lock()
+
+
+def get_conf_stamp(conf_path):
+    """ Returns pacman.conf modification time (None if it does not exist) """
+    try:
+        return os.stat(conf_path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class AlpmSession():
+    """ A Pac object (alpm handle with its databases loaded) and when its
+        sync databases were refreshed """
+
+    def __init__(self, conf_path, callback_queue=None):
+        self.conf_path = conf_path
+        self.conf_stamp = get_conf_stamp(conf_path)
+        self.pacman = pac.Pac(conf_path, callback_queue)
+        self.last_refresh = None
+
+    def get_stamp_path(self):
+        """ File that stores when sync databases were last refreshed
+            (database mtimes are the servers' Last-Modified times) """
+        conf = self.pacman.get_config()
+        return os.path.join(conf.options['DBPath'], 'sync', REFRESH_STAMP)
+
+    def get_repos(self):
+        """ Returns repositories and their servers (Included ones, too) """
+        repos = self.pacman.get_config().repos
+        return {repo: list(servers) for repo, servers in repos.items()}
+
+    def read_stamp(self):
+        """ Returns the time of the last refresh (of any Cnchi run) or None
+            if it was done with other repositories or servers """
+        try:
+            with open(self.get_stamp_path(), 'r') as stamp_file:
+                stamp = json.load(stamp_file)
+            if stamp['repos'] != self.get_repos():
+                logging.debug("Repositories have changed since last refresh")
+                return None
+            return float(stamp['time'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def write_stamp(self):
+        """ Stores the time of the last refresh (and which repositories
+            and servers were used) """
+        stamp = {'time': time.time(), 'repos': self.get_repos()}
+        try:
+            with open(self.get_stamp_path(), 'w') as stamp_file:
+                json.dump(stamp, stamp_file)
+        except OSError as err:
+            logging.debug("Can't write refresh stamp: %s", err)
+
+    def has_databases(self):
+        """ True if all sync database files exist """
+        conf = self.pacman.get_config()
+        sync_path = os.path.join(conf.options['DBPath'], 'sync')
+        return all(
+            os.path.exists(os.path.join(sync_path, repo + '.db'))
+            for repo in conf.repos)
+
+    def is_fresh(self, max_age=REFRESH_MAX_AGE):
+        """ True if sync databases have been refreshed less than max_age
+            seconds ago (by this session or by a previous Cnchi run with
+            the same repositories) """
+        if not self.has_databases():
+            return False
+        if self.last_refresh is not None:
+            return time.monotonic() - self.last_refresh < max_age
+        stamp = self.read_stamp()
+        return stamp is not None and 0 <= time.time() - stamp < max_age
+
+    def refresh(self, force=False, max_age=REFRESH_MAX_AGE, proxies=None):
+        """ Updates sync databases unless they are fresh enough (force
+            ignores max_age). All databases are downloaded at the same time
+            and only if they have changed. libalpm is used if that fails """
+        if not force and self.is_fresh(max_age):
+            logging.debug("Databases of %s are up to date", self.conf_path)
+            return True
+
+        res = DatabaseRefresh(self.pacman.get_config(), proxies).refresh()
+        if res:
+            # New handle, so databases are read again
+            self.pacman.release()
+            self.pacman.initialize_alpm()
+        else:
+            logging.warning("Can't refresh databases, let's try with libalpm")
+            res = self.pacman.refresh()
+
+        if res:
+            self.last_refresh = time.monotonic()
+            self.write_stamp()
+        return res
+
+    def release(self):
+        """ Releases alpm handle """
+        self.pacman.release()
+
+
+def get_session(conf_path, callback_queue=None):
+    """ Returns the session of pacman.conf file conf_path (Cnchi uses one
+        pacman.conf for the live system and another one for the new
+        installation, each one with its own root and database path).
+        It is created the first time (or if conf_path has been modified
+        since). Events will be sent to callback_queue """
+    conf_stamp = get_conf_stamp(conf_path)
+    with _LOCK:
+        session = _SESSIONS.get(conf_path)
+        if session is not None and session.conf_stamp != conf_stamp:
+            logging.debug("%s has changed, reloading alpm", conf_path)
+            session.release()
+            session = None
+
+        if session is None:
+            session = AlpmSession(conf_path, callback_queue)
+            _SESSIONS[conf_path] = session
+        elif callback_queue is not None:
+            session.pacman.events = Events(callback_queue)
+
+        return session
+
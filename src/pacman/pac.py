@@ -31,7 +31,6 @@
 
 """ Module interface to pyalpm """
 
-from collections import OrderedDict
 
 import logging
 import os
@@ -42,6 +41,7 @@ from misc.events import Events
 import pacman.alpm_include as _alpm
 import pacman.pkginfo as pkginfo
 import pacman.pacman_conf as config
+from pacman.sync_index import SyncIndex
 
 try:
     import pyalpm
@@ -71,6 +71,7 @@ class Pac():
         self.conflict_to_remove = None
 
         self.handle = None
+        self.sync_index = None
 
         self.logger = None
         self.setup_logger()
@@ -119,6 +120,13 @@ class Pac():
         """ Get pacman.conf config """
         return self.config
 
+    def get_sync_index(self):
+        """ Returns the name and provides index of the sync databases
+            (it is built the first time it is used) """
+        if self.sync_index is None:
+            self.sync_index = SyncIndex(self.handle)
+        return self.sync_index
+
     def initialize_alpm(self):
         """ Set alpm setup """
         if self.config is not None:
@@ -157,6 +165,7 @@ class Pac():
 
     def release(self):
         """ Release alpm handle """
+        self.sync_index = None
         if self.handle is not None:
             del self.handle
             self.handle = None
@@ -238,6 +247,9 @@ class Pac():
             logging.error("alpm is not initialised")
             raise pyalpm.error
 
+        # Databases are going to change
+        self.sync_index = None
+
         force = True
         res = True
         for database in self.handle.get_syncdbs():
@@ -269,56 +281,40 @@ class Pac():
         # Discard duplicates
         pkgs = list(set(pkgs))
 
-        # `alpm.handle.get_syncdbs()` returns a list (the order is important) so we
-        # have to ensure we don't clobber the priority of the repos.
-        repos = OrderedDict()
-        repo_order = []
-        db_match = [db for db in self.handle.get_syncdbs()
-                    if db.name == 'antergos']
-        antdb = OrderedDict()
-        antdb['antergos'] = db_match[0]
+        sync_index = self.get_sync_index()
 
+        # Packages of these groups should be sourced from the antergos repo only
         one_repo_groups_names = ['cinnamon', 'mate', 'mate-extra']
-        one_repo_groups = []
+        one_repo_pkgs = set()
         for one_repo_group_name in one_repo_groups_names:
-            grp = antdb['antergos'].read_grp(one_repo_group_name)
-            if not grp:
-                # Group does not exist
-                grp = ['None', []]
-            one_repo_groups.append(grp)
-
-        one_repo_pkgs = {pkg for one_repo_group in one_repo_groups
-                         for pkg in one_repo_group[1] if one_repo_group}
-
-        for syncdb in self.handle.get_syncdbs():
-            repo_order.append(syncdb)
-            repos[syncdb.name] = syncdb
+            one_repo_pkgs.update(
+                pkg.name for pkg in sync_index.get_group(one_repo_group_name, 'antergos'))
 
-        targets = []
+        # Package name: sync package
+        targets = {}
         for name in pkgs:
-            _repos = repos
-
             if name in one_repo_pkgs:
-                # pkg should be sourced from the antergos repo only.
-                _repos = antdb
-
-            result_ok, pkg = self.find_sync_package(name, _repos)
+                pkg = sync_index.get_package(name, 'antergos')
+            else:
+                pkg = sync_index.get_package(name)
 
-            if result_ok:
+            if pkg is not None:
                 # Check that added package is not in our conflicts list
                 if pkg.name not in conflicts:
-                    targets.append(pkg.name)
+                    targets[pkg.name] = pkg
             else:
                 # Couldn't find the package, check if it's a group
-                group_pkgs = self.get_group_pkgs(name)
-                if group_pkgs is not None:
+                group_pkgs = sync_index.get_group(name)
+                if group_pkgs:
                     # It's a group
                     for group_pkg in group_pkgs:
                         # Check that added package is not in our conflicts list
                         # Ex: connman conflicts with netctl(openresolv),
                         # which is installed by default with base group
                         if group_pkg.name not in conflicts:
-                            targets.append(group_pkg.name)
+                            # Use the package from the first repo that has it
+                            targets[group_pkg.name] = (
+                                sync_index.get_package(group_pkg.name) or group_pkg)
                 else:
                     # No, it wasn't neither a package nor a group. As we don't
                     # know if this error is fatal or not, we'll register it and
@@ -326,9 +322,7 @@ class Pac():
                     logging.error(
                         "Can't find a package or group called '%s'", name)
 
-        # Discard duplicates
-        targets = list(set(targets))
-        logging.debug(targets)
+        logging.debug(list(targets.keys()))
 
         if not targets:
             logging.error("No targets found")
@@ -347,12 +341,8 @@ class Pac():
             logging.error("Can't initialize alpm transaction")
             return False
 
-        for _index in range(0, num_targets):
-            result_ok, pkg = self.find_sync_package(targets.pop(), repos)
-            if result_ok:
-                transaction.add_pkg(pkg)
-            else:
-                logging.warning(pkg)
+        for pkg in targets.values():
+            transaction.add_pkg(pkg)
 
         return self.finalize_transaction(transaction)
 
@@ -392,24 +382,11 @@ class Pac():
 
         return self.finalize_transaction(transaction)
 
-    @staticmethod
-    def find_sync_package(pkgname, syncdbs):
-        """ Finds a package name in a list of DBs
-        :rtype : tuple (True/False, package or error message)
-        """
-        for database in syncdbs.values():
-            pkg = database.get_pkg(pkgname)
-            if pkg is not None:
-                return True, pkg
-        return False, "Package '{0}' was not found.".format(pkgname)
-
     def get_group_pkgs(self, group):
         """ Get group's packages """
-        for repo in self.handle.get_syncdbs():
-            grp = repo.read_grp(group)
-            if grp is not None:
-                _name, pkgs = grp
-                return pkgs
+        pkgs = self.get_sync_index().get_group(group)
+        if pkgs:
+            return pkgs
         return None
 
     def get_packages_info(self, pkg_names=None):
@@ -426,29 +403,26 @@ class Pac():
                         level=2,
                         style='sync')
         else:
-            repos = OrderedDict((database.name, database)
-                                for database in self.handle.get_syncdbs())
+            sync_index = self.get_sync_index()
             for pkg_name in pkg_names:
-                result_ok, pkg = self.find_sync_package(pkg_name, repos)
-                if result_ok:
+                pkg = sync_index.get_package(pkg_name)
+                if pkg is not None:
                     packages_info[pkg_name] = pkginfo.get_pkginfo(
                         pkg,
                         level=2,
                         style='sync')
                 else:
                     packages_info = {}
-                    logging.error(pkg)
+                    logging.error("Package '%s' was not found.", pkg_name)
         return packages_info
 
     def get_package_info(self, pkg_name):
         """ Get information about packages like pacman -Si """
-        repos = OrderedDict((database.name, database)
-                            for database in self.handle.get_syncdbs())
-        result_ok, pkg = self.find_sync_package(pkg_name, repos)
-        if result_ok:
+        pkg = self.get_sync_index().get_package(pkg_name)
+        if pkg is not None:
             info = pkginfo.get_pkginfo(pkg, level=2, style='sync')
         else:
-            logging.error(pkg)
+            logging.error("Package '%s' was not found.", pkg_name)
             info = {}
         return info
 
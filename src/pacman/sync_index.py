@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  sync_index.py
+#
+#  Copyright © 2013-2018 Antergos
+#
+#  This file is part of Cnchi.
+#
+#  Cnchi is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Cnchi is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  The following additional terms are in effect as per Section 7 of the license:
+#
+#  The preservation of all legal notices and author attributions in
+#  the material or in the Appropriate Legal Notices displayed
+#  by works containing it is required.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Index of sync databases packages (by name, provides and group) """
+
+import logging
+import re
+
+try:
+    import pyalpm
+except ImportError as err:
+    # This is already logged elsewhere
+    # logging.error(err)
+    pass
+
+
+class SyncIndex():
+    """ Indexes the packages of all sync databases of an alpm handle by
+        name, provides and group (just one pass over each pkgcache) and
+        remembers which package satisfies each dependency string """
+
+    def __init__(self, handle):
+        self.handle = handle
+        # List of (database, {name: [pkgs]}) in repo order
+        self.db_indexes = None
+        # Database name: {group name: [pkgs]}
+        self.db_groups = None
+        # Dependency string: package that satisfies it (or None)
+        self.satisfiers = {}
+        # Dependency string: True if an installed package satisfies it
+        self.local_satisfied = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_dep_name(dep):
+        """ Removes version restrictions from a dependency (or provides)
+            string: 'glibc>=2.26' -> 'glibc' """
+        return re.split('[<>=]', dep, 1)[0]
+
+    def get_db_indexes(self):
+        """ Builds per database name and provides indexes (only once) """
+        if self.db_indexes is None:
+            self.db_indexes = []
+            self.db_groups = {}
+            for database in self.handle.get_syncdbs():
+                index = {}
+                groups = {}
+                for pkg in database.pkgcache:
+                    index.setdefault(pkg.name, []).append(pkg)
+                    for provide in pkg.provides:
+                        name = self.get_dep_name(provide)
+                        if name != pkg.name:
+                            index.setdefault(name, []).append(pkg)
+                    for group in pkg.groups:
+                        groups.setdefault(group, []).append(pkg)
+                self.db_indexes.append((database, index))
+                self.db_groups[database.name] = groups
+        return self.db_indexes
+
+    def get_package(self, name, repo=None):
+        """ Returns the sync package called name (following repo order).
+            If repo is given, only that database is searched """
+        for database, index in self.get_db_indexes():
+            if repo is not None and database.name != repo:
+                continue
+            for pkg in index.get(name, []):
+                if pkg.name == name:
+                    return pkg
+        return None
+
+    def get_group(self, name, repo=None):
+        """ Returns the packages of group name from the first database that
+            has it (or from repo, if given). Empty if it does not exist """
+        for database, _index in self.get_db_indexes():
+            if repo is not None and database.name != repo:
+                continue
+            pkgs = self.db_groups[database.name].get(name)
+            if pkgs:
+                return pkgs
+        return []
+
+    def is_available(self, name):
+        """ True if there is a package called name, a package that
+            provides name or a group called name """
+        return bool(
+            self.get_package(name) or
+            self.find_satisfier(name) or
+            self.get_group(name))
+
+    def get_version(self, name):
+        """ Returns the version of package name (or of the package that
+            provides it). None if there is none """
+        pkg = self.get_package(name) or self.find_satisfier(name)
+        if pkg:
+            return pkg.version
+        return None
+
+    def find_missing(self, names):
+        """ Returns the names that are not available (see is_available) """
+        return [name for name in names if not self.is_available(name)]
+
+    def find_satisfier(self, dep):
+        """ Returns the first sync package (following repo order) that
+            satisfies dep, like pyalpm.find_satisfier(database.pkgcache, dep)
+            does for each database. Results are cached """
+        try:
+            prov = self.satisfiers[dep]
+            self.hits += 1
+            return prov
+        except KeyError:
+            self.misses += 1
+
+        name = self.get_dep_name(dep)
+        prov = None
+        for _database, index in self.get_db_indexes():
+            candidates = index.get(name)
+            if candidates:
+                # Only packages called 'name' or providing it can satisfy dep
+                prov = pyalpm.find_satisfier(candidates, dep)
+                if prov:
+                    break
+
+        self.satisfiers[dep] = prov
+        return prov
+
+    def is_installed(self, dep):
+        """ True if an installed package satisfies dep (cached) """
+        try:
+            return self.local_satisfied[dep]
+        except KeyError:
+            local_cache = self.handle.get_localdb().pkgcache
+            satisfied = pyalpm.find_satisfier(local_cache, dep) is not None
+            self.local_satisfied[dep] = satisfied
+            return satisfied
+
+    def get_hit_rate(self):
+        """ Returns the fraction of find_satisfier calls that were cached """
+        total = self.hits + self.misses
+        if total:
+            return self.hits / total
+        return 0
+
+    def log_stats(self):
+        """ Logs satisfier cache hit rate """
+        logging.debug(
+            "Satisfier cache: %d hits, %d misses (%.1f%% hit rate)",
+            self.hits, self.misses, self.get_hit_rate() * 100)
@@ -46,6 +46,7 @@ except ImportError:
 import cairo
 from pages.gtkbasebox import GtkBaseBox
 from rank_mirrors import RankMirrors
+import mirrorlist
 
 if __name__ == '__main__':
     import sys
@@ -147,60 +148,23 @@ class MirrorListBox(Gtk.ListBox):
         self.load_mirrors()
         self.fillme()
 
-    @staticmethod
-    def uncommented_mirrors_first(mirrors):
-        """ Put uncommented mirrors first. Order is not guaranteed """
-        commented = []
-        uncommented = []
-        for mirror in mirrors:
-            if mirror.startswith("#"):
-                commented.append(mirror)
-            else:
-                uncommented.append(mirror)
-        return uncommented + commented
-
     def load_mirrors(self):
         """ Load mirrors from text file """
-        lines = []
-
         if not os.path.exists(self.mirrors_file_path):
             logging.error(
                 "Could not find %s file", self.mirrors_file_path)
             return
 
-        # Load mirror file contents
-        with open(self.mirrors_file_path) as mfile:
-            lines = mfile.readlines()
-
-        # Discard lines that are not server lines
-        tmp_lines = lines
-        lines = []
-        for line in tmp_lines:
-            line = line.strip()
-            if line.startswith("Server") or line.startswith("#Server"):
-                lines.append(line)
-        tmp_lines = []
+        servers = mirrorlist.get_mirrorlist(self.mirrors_file_path).servers
 
-        lines = self.uncommented_mirrors_first(lines)
+        # Put uncommented mirrors first
+        servers = [server for server in servers if server[1]] + \
+            [server for server in servers if not server[1]]
 
         # Use MAX_MIRRORS at max
-        if len(lines) > MirrorListBox.MAX_MIRRORS:
-            lines = lines[0:MirrorListBox.MAX_MIRRORS]
-
-        # Read mirror info and create mirrors list
-        for line in lines:
-            if line.startswith("#Server"):
-                active = False
-                line = line[1:]
-            else:
-                active = True
-
-            try:
-                url = line.split("=")[1].strip()
-                logging.debug(url)
-                self.mirrors.append((url, active))
-            except KeyError:
-                pass
+        for url, active in servers[:MirrorListBox.MAX_MIRRORS]:
+            logging.debug(url)
+            self.mirrors.append((url, active))
 
     def fillme(self):
         """ Fill listbox with mirrors info """
@@ -288,17 +252,12 @@ class MirrorListBox(Gtk.ListBox):
     @staticmethod
     def trim_mirror_url(server_line):
         """ Get url from full mirrorlist line """
-
-        if not server_line.startswith("Server") or '=' not in server_line:
-            return server_line
-
-        # Get url part
-        url = server_line.split('=')[1].strip()
+        server = mirrorlist.parse_server_line(server_line)
+        if server:
+            server_line = server[0]
 
         # Remove end part to get the FDQN only
-        url = url.replace("/$repo/os/$arch", "")
-
-        return url
+        return mirrorlist.trim_url(server_line)
 
     def save_changes(self, use_rankmirrors=False):
         """ Save mirrors in mirrors list file """
@@ -30,20 +30,28 @@
 
 """ Creates mirrorlist sorted by both latest updates and fastest connection """
 
+import concurrent.futures
+import hashlib
 import http.client
+import json
 import logging
+import math
 import multiprocessing
 import os
 import queue
-import subprocess
 import threading
 import time
 import urllib.request
 import urllib.error
 
 import feedparser
+import geoip2.errors
+import pyalpm
 import requests
 
+import geoip
+import mirrorlist
+import pacman.pac as pac
 import update_db
 import misc.extra as misc
 
@@ -77,6 +85,31 @@ class RankMirrors(multiprocessing.Process):
         'arch': 'core/os/x86_64/{0}-{1}-x86_64.pkg.tar.xz',
         'antergos': '/{0}-{1}-any.pkg.tar.xz'}
 
+    # Only the mirrors with less latency (time to first byte) are speed tested
+    SPEED_TEST_MIRRORS = 10
+    PROBE_TIMEOUT = 3
+    PROBE_THREADS = 32
+
+    # Minimum seconds between two progress updates sent through fraction_pipe
+    FRACTION_INTERVAL = 0.1
+    # Part of the progress bar used by latency probes (speed tests use the rest)
+    PROBE_FRACTION = 0.3
+
+    # Ranking results are stored here (inside settings['temp']) and reused
+    # for settings['rankmirrors_cache_ttl'] seconds on the same network
+    CACHE_FILENAME = 'rankmirrors-cache.json'
+    CACHE_DEFAULT_DIR = '/var/tmp/cnchi'
+    # Mirrors of each repository checked again when the stored ranking is used
+    SPOT_CHECK_MIRRORS = 3
+
+    # Only Arch mirrors closer than GEO_MAX_DISTANCE km are tested, unless
+    # less than GEO_MIN_MIRRORS remain (then all of them are tested)
+    GEO_MAX_DISTANCE = 3000
+    GEO_MIN_MIRRORS = 20
+    ZONE_TAB = '/usr/share/zoneinfo/zone.tab'
+    # Seconds to wait for our GeoIP location (it needs our public IP)
+    GEOIP_TIMEOUT = 10
+
     def __init__(self, fraction_pipe, settings):
         """ Initialize process class
             fraction_pipe is a pipe used to send progress for a gtk.progress widget update
@@ -87,6 +120,7 @@ class RankMirrors(multiprocessing.Process):
         # Antergos mirrors info is returned as RSS, arch's as JSON
         self.data = {'arch': {}, 'antergos': {}}
         self.mirrorlist_ranked = {'arch': [], 'antergos': []}
+        self.last_fraction_time = 0
 
     @staticmethod
     def is_good_mirror(mirror):
@@ -101,6 +135,114 @@ class RankMirrors(multiprocessing.Process):
                 mirror['protocol'] == 'http' and
                 int(mirror['delay']) <= 3600)
 
+    @staticmethod
+    def lookup_location(result):
+        """ Stores our GeoIP location in result (runs in its own thread) """
+        try:
+            result.append(geoip.GeoIP().get_location())
+        except (geoip2.errors.GeoIP2Error, OSError, ValueError) as err:
+            # Our address may not be in the database (AddressNotFoundError)
+            logging.debug("Can't get location from GeoIP: %s", err)
+
+    def get_location(self):
+        """ Returns our (latitude, longitude) or None if it can't be found.
+            The one chosen in the timezone screen is used if it is already
+            known, GeoIP otherwise (giving up after GEOIP_TIMEOUT seconds) """
+        if self.settings:
+            latitude = self.settings.get('timezone_latitude')
+            longitude = self.settings.get('timezone_longitude')
+            if latitude and longitude:
+                return (float(latitude), float(longitude))
+
+        result = []
+        lookup_thread = threading.Thread(
+            target=self.lookup_location, args=(result,), daemon=True)
+        lookup_thread.start()
+        lookup_thread.join(RankMirrors.GEOIP_TIMEOUT)
+        if not result:
+            if lookup_thread.is_alive():
+                logging.debug("GeoIP lookup timed out, mirrors won't be filtered by distance")
+            return None
+
+        location = result[0]
+        if location and location.latitude is not None and location.longitude is not None:
+            return (location.latitude, location.longitude)
+        return None
+
+    @staticmethod
+    def parse_coordinate(position, degree_digits):
+        """ Converts a ISO 6709 coordinate (as in zone.tab) to degrees:
+            +DDMM[SS] (latitude) or +DDDMM[SS] (longitude) """
+        sign = -1 if position[0] == '-' else 1
+        digits = position[1:]
+        degrees = int(digits[:degree_digits])
+        minutes = int(digits[degree_digits:degree_digits + 2])
+        seconds = int(digits[degree_digits + 2:] or 0)
+        return sign * (degrees + minutes / 60 + seconds / 3600)
+
+    @staticmethod
+    def get_country_coordinates():
+        """ Reads zone.tab and returns a dict with the coordinates
+            (of its first time zone) of each country code """
+        coordinates = {}
+        try:
+            with open(RankMirrors.ZONE_TAB, 'r') as zone_file:
+                for line in zone_file:
+                    if line.startswith('#'):
+                        continue
+                    fields = line.split('\t')
+                    if len(fields) < 3 or fields[0] in coordinates:
+                        continue
+                    latlong = fields[1]
+                    split = max(latlong.rfind('+'), latlong.rfind('-'))
+                    coordinates[fields[0]] = (
+                        RankMirrors.parse_coordinate(latlong[:split], 2),
+                        RankMirrors.parse_coordinate(latlong[split:], 3))
+        except (OSError, ValueError) as err:
+            logging.debug("Can't read %s: %s", RankMirrors.ZONE_TAB, err)
+        return coordinates
+
+    @staticmethod
+    def get_distance(origin, destination):
+        """ Great circle distance (km) between two (latitude, longitude) """
+        lat1, lon1 = (math.radians(value) for value in origin)
+        lat2, lon2 = (math.radians(value) for value in destination)
+        hav = (math.sin((lat2 - lat1) / 2) ** 2 +
+               math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+        return 2 * 6371 * math.asin(math.sqrt(min(1, hav)))
+
+    def filter_mirrors_by_distance(self, mirrors, location):
+        """ Sorts Arch mirrors by their distance to location and removes the
+            ones that are too far. Mirrors without a country (CDNs) are
+            always kept. If too few mirrors remain, all are returned """
+        coordinates = self.get_country_coordinates()
+        if not location or not coordinates:
+            return mirrors
+
+        distances = {}
+        for mirror in mirrors:
+            country = coordinates.get(mirror.get('country_code'))
+            if country:
+                distances[mirror['url']] = self.get_distance(location, country)
+            else:
+                distances[mirror['url']] = 0
+
+        mirrors = sorted(mirrors, key=lambda mirror: distances[mirror['url']])
+        near_mirrors = [
+            mirror for mirror in mirrors
+            if distances[mirror['url']] <= RankMirrors.GEO_MAX_DISTANCE]
+
+        if len(near_mirrors) < RankMirrors.GEO_MIN_MIRRORS:
+            logging.debug(
+                "Only %d Arch mirrors near you, testing all of them",
+                len(near_mirrors))
+            return mirrors
+
+        logging.debug(
+            "Testing %d of %d Arch mirrors (the ones near you)",
+            len(near_mirrors), len(mirrors))
+        return near_mirrors
+
     def get_mirror_stats(self):
         """ Retrieve all mirrors status RSS data. """
         # Load status data (JSON) for arch mirrors
@@ -127,6 +269,8 @@ class RankMirrors(multiprocessing.Process):
             mirrors['arch'] = self.data['arch']['urls']
             mirrors['arch'] = [m for m in mirrors['arch'] if self.is_good_mirror(m)]
             #self.data['arch']['urls'] = mirrors['arch']
+            mirrors['arch'] = self.filter_mirrors_by_distance(
+                mirrors['arch'], self.get_location())
         except KeyError as err:
             logging.warning('Failed to parse retrieved mirror data: %s', err)
 
@@ -145,32 +289,89 @@ class RankMirrors(multiprocessing.Process):
     @staticmethod
     def get_antergos_mirror_url(mirror_url):
         """ Get full mirror url from the stats mirror url """
-        lines = []
         mirrorlist_path = RankMirrors.MIRRORLIST['antergos']
-        with open(mirrorlist_path, 'r') as mirror_file:
-            lines = mirror_file.readlines()
-        for line in lines:
-            if mirror_url in line:
-                return line.split('=')[1].strip()
-        logging.warning("%s not found in %s", mirror_url, mirrorlist_path)
-        return None
+        url = mirrorlist.get_mirrorlist(mirrorlist_path).find_url(mirror_url)
+        if url is None:
+            logging.warning("%s not found in %s", mirror_url, mirrorlist_path)
+        return url
+
+    def get_package_versions(self, names):
+        """ Returns a dict with the version of each package (using the
+            sync databases). Version is False if it can't be found """
+        versions = dict.fromkeys(names, False)
+        conf_path = '/etc/pacman.conf'
+        if self.settings and self.settings.get('pacman_config_file'):
+            conf_path = self.settings.get('pacman_config_file')
+        try:
+            pacman = pac.Pac(conf_path)
+            sync_index = pacman.get_sync_index()
+            for name in names:
+                versions[name] = sync_index.get_version(name) or False
+                logging.debug(
+                    '%s version is: %s (used to test mirror speed)', name, versions[name])
+            pacman.release()
+        except pyalpm.error as err:
+            logging.warning("Can't get packages versions: %s", err)
+        return versions
 
     @staticmethod
-    def get_package_version(name):
-        """ Returns pkg_name package version """
+    def probe_latency(full_url):
+        """ Returns seconds until the first byte of full_url arrives
+            (the body is not downloaded) or None if the mirror fails """
         try:
-            cmd = ["/usr/bin/pacman", "-Ss", name]
-            line = subprocess.check_output(cmd).decode().split()
-            version = line[1]
-            logging.debug(
-                '%s version is: %s (used to test mirror speed)', name, version)
-        except subprocess.CalledProcessError as err:
-            logging.warning(err)
-            version = False
-        return version
+            with requests.get(full_url, stream=True,
+                              timeout=RankMirrors.PROBE_TIMEOUT) as req:
+                if req.status_code >= 400:
+                    return None
+                return req.elapsed.total_seconds()
+        except requests.RequestException as err:
+            logging.debug("Couldn't probe %s: %s", full_url, err)
+            return None
+
+    def probe_mirrors(self, urls, max_threads=None, progress=None):
+        """ Measures latency of all mirrors concurrently. urls is a list
+            of (repo, mirror url, full url). Returns the list sorted by
+            latency (unreachable mirrors are removed). progress(done, total)
+            is called each time a probe finishes """
+        if not urls:
+            return []
+        max_threads = max_threads or RankMirrors.PROBE_THREADS
+        latencies = {}
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(max_threads, len(urls))) as executor:
+            future_to_url = {
+                executor.submit(self.probe_latency, url[2]): url
+                for url in urls}
+            for num_done, future in enumerate(
+                    concurrent.futures.as_completed(future_to_url), 1):
+                latency = future.result()
+                if latency is not None:
+                    latencies[future_to_url[future]] = latency
+                if progress:
+                    progress(num_done, len(urls))
+        urls = sorted(latencies, key=latencies.get)
+        for url in urls:
+            logging.debug("%s: %.0f ms", url[1], latencies[url] * 1000)
+        return urls
+
+    def send_fraction(self, fraction, force=False):
+        """ Sends progress through fraction_pipe (at most once every
+            FRACTION_INTERVAL seconds, unless force is True) """
+        if not self.fraction_pipe:
+            return
+        now = time.monotonic()
+        if force or now - self.last_fraction_time >= RankMirrors.FRACTION_INTERVAL:
+            self.fraction_pipe.send(fraction)
+            self.last_fraction_time = now
 
     def sort_mirrors_by_speed(self, mirrors=None, max_threads=8):
-        """ Sorts mirror list """
+        """ Sorts mirror list. First, the latency of all mirrors is probed
+            (cheap, just the response headers). Then, only the
+            SPEED_TEST_MIRRORS mirrors of each repository with less latency
+            get a full download speed test. The rest of them are kept after
+            those, sorted by latency. Mirrors of both repositories are tested
+            at the same time, sharing the same threads. max_threads limits
+            the whole run (latency probes and speed tests) """
 
         test_packages = {
             'arch': {'name':'cryptsetup', 'version': ''},
@@ -178,53 +379,17 @@ class RankMirrors(multiprocessing.Process):
 
         rated_mirrors = {'arch': [], 'antergos': []}
 
+        versions = self.get_package_versions(
+            [value['name'] for value in test_packages.values()])
         for key, value in test_packages.items():
-            test_packages[key]['version'] = self.get_package_version(value['name'])
-
-        total_num_mirrors = 0
-        for key in mirrors.keys():
-            total_num_mirrors += len(mirrors[key])
-        num_mirrors_done = 0
-        old_fraction = -1
-
-        num_threads = min(max_threads, total_num_mirrors)
-        # URL input queue.Queue
-        q_in = queue.Queue()
-        # URL and rate output queue.Queue
-        q_out = queue.Queue()
-
-        name = ""
-        version = ""
-        rates = {}
+            test_packages[key]['version'] = versions[value['name']]
 
+        # Compose test urls of all repositories: (repo, mirror url, full url)
+        urls = []
+        url_len = 0
         for repo in RankMirrors.REPOSITORIES:
             name = test_packages[repo]['name']
             version = test_packages[repo]['version']
-
-            def worker():
-                """ worker thread. Retrieves data to test mirror speed """
-                while not q_in.empty():
-                    mirror_url, full_url = q_in.get()
-                    # Leave the rate as 0 if the connection fails.
-                    rate = 0
-                    dtime = float('NaN')
-                    if full_url:
-                        req = urllib.request.Request(url=full_url)
-                        try:
-                            time0 = time.time()
-                            with urllib.request.urlopen(req, None, 5) as my_file:
-                                size = len(my_file.read())
-                                dtime = time.time() - time0
-                                rate = size / dtime
-                        except (OSError, urllib.error.HTTPError,
-                                http.client.HTTPException) as err:
-                            logging.warning("Couldn't download %s", full_url)
-                            logging.warning(err)
-                    q_out.put((mirror_url, full_url, rate, dtime))
-                    q_in.task_done()
-
-            # Load the input queue.Queue
-            url_len = 0
             for mirror in mirrors[repo]:
                 url_len = max(url_len, len(mirror['url']))
                 if repo == 'antergos':
@@ -240,62 +405,113 @@ class RankMirrors(multiprocessing.Process):
                 else:
                     package_url = mirror['url']
                 if mirror['url'] and package_url:
-                    q_in.put((mirror['url'], package_url))
-
-            # Launch threads
-            my_threads = []
-            for _index in range(num_threads):
-                my_thread = threading.Thread(target=worker)
-                my_thread.start()
-                my_threads.append(my_thread)
+                    urls.append((repo, mirror['url'], package_url))
 
             # Remove mirrors that are not present in antergos-mirrorlist
-            if repo == 'antergos':
-                mirrors_pruned = []
-                for mirror in mirrors[repo]:
-                    if mirror['url'] is not None:
-                        mirrors_pruned.append(mirror)
-                mirrors[repo] = mirrors_pruned
-
-            # Wait for queue to empty
-            while not q_in.empty():
-                fraction = (float(q_out.qsize()) + num_mirrors_done) / float(total_num_mirrors)
-                if fraction != old_fraction:
-                    if self.fraction_pipe:
-                        self.fraction_pipe.send(fraction)
-                    old_fraction = fraction
-
-            num_mirrors_done += q_out.qsize()
-
-            # Wait for all threads to complete
-            q_in.join()
-
-            # Log some extra data.
-            url_len = str(url_len)
-            fmt = '%-' + url_len + 's  %14s  %9s'
-            logging.debug(fmt, _("Server"), _("Rate"), _("Time"))
-
-            # Loop over the mirrors just to ensure that we get the rate for each.
-            # The value in the loop does not (necessarily) correspond to the mirror.
-            fmt = '%-' + url_len + 's  %8.2f KiB/s  %7.2f s'
-            for mirror in mirrors[repo]:
-                url, full_url, rate, dtime = q_out.get()
-                if full_url:
-                    kibps = rate / 1024.0
-                    logging.debug(fmt, url, kibps, dtime)
-                    rates[url] = rate
-                q_out.task_done()
+            mirrors[repo] = [m for m in mirrors[repo] if m['url'] is not None]
+
+        # First phase: probe latency of all mirrors
+        probe_fraction = RankMirrors.PROBE_FRACTION
+        urls = self.probe_mirrors(
+            urls,
+            max_threads=max_threads,
+            progress=lambda done, total: self.send_fraction(probe_fraction * done / total))
+
+        # Mirrors with less latency are speed tested, the rest are not
+        shortlist = []
+        untested = {'arch': [], 'antergos': []}
+        for repo in RankMirrors.REPOSITORIES:
+            repo_urls = [url for url in urls if url[0] == repo]
+            shortlist.extend(repo_urls[:RankMirrors.SPEED_TEST_MIRRORS])
+            untested[repo] = [
+                mirror_url for _repo, mirror_url, _full_url
+                in repo_urls[RankMirrors.SPEED_TEST_MIRRORS:]]
+            logging.debug(
+                "%d %s mirrors answered, testing the speed of the first %d",
+                len(repo_urls), repo, min(len(repo_urls), RankMirrors.SPEED_TEST_MIRRORS))
+
+        total_num_mirrors = max(len(shortlist), 1)
+        num_mirrors_done = 0
+
+        num_threads = min(max_threads, total_num_mirrors)
+        # URL input queue.Queue
+        q_in = queue.Queue()
+        # URL and rate output queue.Queue
+        q_out = queue.Queue()
 
-            # Wait for all threads to finnish (all will be finished, but...)
-            for my_thread in my_threads:
-                my_thread.join()
+        rates = {}
 
+        def worker():
+            """ worker thread. Retrieves data to test mirror speed """
+            while True:
+                try:
+                    repo, mirror_url, full_url = q_in.get_nowait()
+                except queue.Empty:
+                    break
+                # Leave the rate as 0 if the connection fails.
+                rate = 0
+                dtime = float('NaN')
+                if full_url:
+                    req = urllib.request.Request(url=full_url)
+                    try:
+                        time0 = time.time()
+                        with urllib.request.urlopen(req, None, 5) as my_file:
+                            size = len(my_file.read())
+                            dtime = time.time() - time0
+                            rate = size / dtime
+                    except (OSError, urllib.error.HTTPError,
+                            http.client.HTTPException) as err:
+                        logging.warning("Couldn't download %s", full_url)
+                        logging.warning(err)
+                q_out.put((repo, mirror_url, full_url, rate, dtime))
+                q_in.task_done()
+
+        # Second phase: speed test of the shortlist (all repositories)
+        # Load the input queue.Queue
+        for url in shortlist:
+            q_in.put(url)
+
+        # Launch threads
+        my_threads = []
+        for _index in range(num_threads):
+            my_thread = threading.Thread(target=worker)
+            my_thread.start()
+            my_threads.append(my_thread)
+
+        # Log some extra data.
+        url_len = str(url_len)
+        fmt = '%-' + url_len + 's  %14s  %9s'
+        logging.debug(fmt, _("Server"), _("Rate"), _("Time"))
+
+        # Wait for the workers' results (each one updates the progress).
+        # The value in the loop does not (necessarily) correspond to the mirror.
+        fmt = '%-' + url_len + 's  %8.2f KiB/s  %7.2f s'
+        for _url in shortlist:
+            repo, url, full_url, rate, dtime = q_out.get()
+            if full_url:
+                kibps = rate / 1024.0
+                logging.debug(fmt, url, kibps, dtime)
+                rates[(repo, url)] = rate
+            q_out.task_done()
+            num_mirrors_done += 1
+            self.send_fraction(
+                probe_fraction + (1 - probe_fraction) * num_mirrors_done / total_num_mirrors)
+
+        # Wait for all threads to finnish (all will be finished, but...)
+        for my_thread in my_threads:
+            my_thread.join()
+
+        # Split results by repository
+        for repo in RankMirrors.REPOSITORIES:
             # Sort mirrors by rate
-            try:
-                rated_mirrors[repo] = [m for m in mirrors[repo] if rates[m['url']] > 0]
-                rated_mirrors[repo].sort(key=lambda m: rates[m['url']], reverse=True)
-            except KeyError as err:
-                logging.warning(err)
+            rated_mirrors[repo] = [
+                m for m in mirrors[repo] if rates.get((repo, m['url']), 0) > 0]
+            rated_mirrors[repo].sort(key=lambda m, repo=repo: rates[(repo, m['url'])], reverse=True)
+
+            # Add mirrors that have not been speed tested (sorted by latency)
+            mirrors_by_url = {m['url']: m for m in mirrors[repo]}
+            rated_mirrors[repo].extend(
+                mirrors_by_url[url] for url in untested[repo] if url in mirrors_by_url)
 
         return rated_mirrors
 
@@ -339,17 +555,25 @@ class RankMirrors(multiprocessing.Process):
         mlist = self.get_mirror_stats()
         mirrors = self.sort_mirrors_by_speed(mirrors=mlist)
 
+        ranked = {}
+        for repo in ['arch', 'antergos']:
+            ranked[repo] = [mirror['url'] for mirror in mirrors[repo]]
+        self.write_mirrorlists(ranked)
+
+    def write_mirrorlists(self, ranked):
+        """ Writes both mirrorlists. ranked has the list of mirror urls
+            (sorted) of each repository """
         for repo in ['arch', 'antergos']:
             self.mirrorlist_ranked[repo] = []
 
         for repo in ['arch', 'antergos']:
             output = '# {} mirrorlist generated by cnchi #\n'.format(repo)
-            for mirror in mirrors[repo]:
-                self.mirrorlist_ranked[repo].append(mirror['url'])
+            for url in ranked[repo]:
+                self.mirrorlist_ranked[repo].append(url)
                 if repo == 'arch':
-                    output += "Server = {0}{1}/os/{2}\n".format(mirror['url'], '$repo', '$arch')
+                    output += "Server = {0}{1}/os/{2}\n".format(url, '$repo', '$arch')
                 else:
-                    output += "Server = {0}\n".format(mirror['url'])
+                    output += "Server = {0}\n".format(url)
 
             # Write modified mirrorlist
             with misc.raised_privileges():
@@ -360,19 +584,133 @@ class RankMirrors(multiprocessing.Process):
                     logging.error(err)
                 update_db.sync()
 
+    @staticmethod
+    def get_network_fingerprint():
+        """ Identifies the network we are connected to using the default
+            gateway address and its MAC address. Returns None if unknown """
+        gateway = None
+        try:
+            with open('/proc/net/route', 'r') as route_file:
+                for line in route_file.readlines()[1:]:
+                    fields = line.split()
+                    # Default route (destination 0.0.0.0)
+                    if len(fields) > 2 and fields[1] == '00000000':
+                        # Gateway address is stored as little endian hex
+                        gateway_hex = bytes.fromhex(fields[2])
+                        gateway = '.'.join(str(byte) for byte in reversed(gateway_hex))
+                        break
+            if gateway is None:
+                return None
+
+            mac = ''
+            with open('/proc/net/arp', 'r') as arp_file:
+                for line in arp_file.readlines()[1:]:
+                    fields = line.split()
+                    if len(fields) > 3 and fields[0] == gateway:
+                        mac = fields[3]
+                        break
+        except (OSError, ValueError) as err:
+            logging.debug("Can't get network fingerprint: %s", err)
+            return None
+
+        return hashlib.sha1('{0} {1}'.format(gateway, mac).encode()).hexdigest()
+
+    def get_cache_path(self):
+        """ Returns where ranking results are stored """
+        cache_dir = None
+        if self.settings:
+            cache_dir = self.settings.get('temp')
+        cache_dir = cache_dir or RankMirrors.CACHE_DEFAULT_DIR
+        return os.path.join(cache_dir, RankMirrors.CACHE_FILENAME)
+
+    def load_cached_ranking(self, fingerprint):
+        """ Returns the ranking stored by a previous run if it is recent
+            enough and it was made in this same network. None otherwise """
+        ttl = 0
+        if self.settings:
+            ttl = self.settings.get('rankmirrors_cache_ttl') or 0
+        if ttl <= 0 or fingerprint is None:
+            return None
+
+        path = self.get_cache_path()
+        try:
+            with open(path, 'r') as cache_file:
+                data = json.load(cache_file)
+            age = time.time() - data['time']
+            if data['fingerprint'] != fingerprint or not 0 <= age <= ttl:
+                logging.debug("Stored mirrors ranking is too old or from another network")
+                return None
+            ranked = {repo: list(data['mirrors'][repo]) for repo in RankMirrors.REPOSITORIES}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            logging.debug("Can't read %s: %s", path, err)
+            return None
+
+        logging.debug("Using mirrors ranking stored %d seconds ago", age)
+        return ranked
+
+    def save_cached_ranking(self, fingerprint):
+        """ Stores ranking results (mirrorlist_ranked) """
+        if fingerprint is None or not self.mirrorlist_ranked['arch']:
+            return
+        path = self.get_cache_path()
+        data = {
+            'time': time.time(),
+            'fingerprint': fingerprint,
+            'mirrors': self.mirrorlist_ranked}
+        tmp_path = path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(data, cache_file)
+            os.rename(tmp_path, path)
+        except OSError as err:
+            logging.debug("Can't write %s: %s", path, err)
+
+    def spot_check_ranking(self, ranked):
+        """ Probes the first mirrors of a stored ranking. The ones that do
+            not answer are moved to the end. Returns None if none of the
+            checked mirrors of a repository answers """
+        urls = []
+        for repo in RankMirrors.REPOSITORIES:
+            for url in ranked[repo][:RankMirrors.SPOT_CHECK_MIRRORS]:
+                full_url = url.replace('$repo', repo).replace('$arch', 'x86_64')
+                urls.append((repo, url, full_url))
+
+        answered = set(url[1] for url in self.probe_mirrors(urls))
+        for repo in RankMirrors.REPOSITORIES:
+            checked = ranked[repo][:RankMirrors.SPOT_CHECK_MIRRORS]
+            if checked and not answered.intersection(checked):
+                logging.debug("Stored %s mirrors do not answer", repo)
+                return None
+            failed = [url for url in checked if url not in answered]
+            ranked[repo] = [url for url in ranked[repo] if url not in failed] + failed
+        return ranked
+
     def run(self):
         """ Run process """
         # Wait until there is an Internet connection available
         while not misc.has_connection():
             time.sleep(2)  # Delay, try again after 2 seconds
 
-        logging.debug("Updating both mirrorlists (Arch and Antergos)...")
-        self.update_mirrorlists()
+        fingerprint = self.get_network_fingerprint()
+        ranked = self.load_cached_ranking(fingerprint)
+        if ranked:
+            ranked = self.spot_check_ranking(ranked)
+
+        if ranked:
+            logging.debug("Writing stored mirrors ranking...")
+            self.write_mirrorlists(ranked)
+        else:
+            logging.debug("Updating both mirrorlists (Arch and Antergos)...")
+            self.update_mirrorlists()
 
-        self.uncomment_mirrors()
+            self.uncomment_mirrors()
 
-        logging.debug("Filtering and sorting mirrors...")
-        self.filter_and_sort_mirrorlists()
+            logging.debug("Filtering and sorting mirrors...")
+            self.filter_and_sort_mirrorlists()
+            self.save_cached_ranking(fingerprint)
 
         if self.settings:
             self.mirrorlist_ranked['arch'] = [
@@ -380,7 +718,7 @@ class RankMirrors(multiprocessing.Process):
             self.settings.set('rankmirrors_result', self.mirrorlist_ranked['arch'])
 
         if self.fraction_pipe:
-            self.fraction_pipe.send(1)
+            self.send_fraction(1, force=True)
             self.fraction_pipe.close()
 
         logging.debug("Auto mirror selection has been run successfully.")